@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import polars as pl
+
+# Sibling modules, package-relative when imported as processing.activity_tensor
+try:
+    from .id_interning import encode
+    from .participant_panel import calendar_index
+except ImportError:
+    from id_interning import encode
+    from participant_panel import calendar_index
+
+# Participant x userMonth arrays of the core activity counters, saved as .npy files that notebooks can memory-map:
+#
+#   from processing.activity_tensor import open_activity_tensor, participant_rows
+#   tensor = open_activity_tensor("data/activity_tensor")
+#   rows = participant_rows("data/activity_tensor", ["<participant id>", ...])
+#
+# Rows are participant keys from the append-only participant lookup (data/id_lookup/participant.parquet), so a row
+# number means the same participant across rebuilds. Two layouts:
+#   - dense: one (participants, months) array per counter, tensor["notesRated"][row, userMonth]
+#   - csr:   rows share indptr.npy / userMonth.npy, and each counter holds the values of the non-empty months, so
+#            participant `row` has months userMonth[indptr[row]:indptr[row + 1]] with notesRated[same slice]
+# firstMonth.npy holds each participant's first calendar month as year * 12 + month - 1 (-1 for unknown keys).
+
+COUNTERS = {
+    "notesCreated": "noteAuthorParticipantId",
+    "hits":         "noteAuthorParticipantId",
+    "notesRated":   "raterParticipantId",
+    "requestsMade": "requesterParticipantId",
+}
+LAYOUTS = ("dense", "csr")
+_COUNTER_DTYPE = np.uint32
+
+
+# One row per (participant key, userMonth) with every counter, zero where the participant had no such activity
+def _counter_frame(trajectories: list[pl.DataFrame], participants: pl.DataFrame) -> pl.DataFrame:
+    parts = []
+    for traj in trajectories:
+        counters = [name for name, id_column in COUNTERS.items() if name in traj.columns and id_column in traj.columns]
+        if counters:
+            id_column = COUNTERS[counters[0]]
+            parts.append(traj.select(pl.col(id_column).alias("participantId"), "userMonth", "calendarMonth", *counters))
+    return (
+        encode(pl.concat(parts, how="diagonal"), "participantId", participants)
+        .group_by("participantId", "userMonth")
+        .agg(
+            _firstMonth=(calendar_index(pl.col("calendarMonth").first()) - pl.col("userMonth").first()),
+            **{name: pl.col(name).sum().cast(pl.UInt32) for name in COUNTERS},
+        )
+        .sort("participantId", "userMonth")
+    )
+
+
+def write_activity_tensor(trajectories: list[pl.DataFrame], participants: pl.DataFrame, root: str, layout: str = "csr") -> None:
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}, expected one of {LAYOUTS}")
+    counters = _counter_frame(trajectories, participants)
+    rows, months = counters["participantId"].to_numpy(), counters["userMonth"].to_numpy()
+    n_rows, n_months = len(participants), int(months.max()) + 1 if len(months) else 0
+
+    tmp = f"{root}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    first_month = np.full(n_rows, -1, dtype=np.int32)
+    first_month[rows] = counters["_firstMonth"].to_numpy()
+    np.save(f"{tmp}/firstMonth.npy", first_month)
+
+    if layout == "dense":
+        for name in COUNTERS:
+            # Filled on disk, so a panel larger than memory never has to exist in RAM
+            array = np.lib.format.open_memmap(f"{tmp}/{name}.npy", mode="w+", dtype=_COUNTER_DTYPE, shape=(n_rows, n_months))
+            array[rows, months] = counters[name].to_numpy()
+            array.flush()
+            del array
+    else:
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        np.save(f"{tmp}/indptr.npy", indptr)
+        np.save(f"{tmp}/userMonth.npy", months.astype(np.int16))
+        for name in COUNTERS:
+            np.save(f"{tmp}/{name}.npy", counters[name].to_numpy().astype(_COUNTER_DTYPE))
+
+    with open(f"{tmp}/_tensor.json", "w") as f:
+        json.dump({"layout": layout, "participants": n_rows, "months": n_months, "counters": list(COUNTERS)}, f)
+    # A copy of the lookup as of this build, so rows can be resolved even after the live lookup has grown
+    participants.write_parquet(f"{tmp}/participant.parquet")
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
+
+
+def open_activity_tensor(root: str) -> dict[str, np.ndarray]:
+    with open(f"{root}/_tensor.json") as f:
+        layout = json.load(f)
+    names = ["firstMonth", *layout["counters"]] + (["indptr", "userMonth"] if layout["layout"] == "csr" else [])
+    return {name: np.load(f"{root}/{name}.npy", mmap_mode="r") for name in names}
+
+
+# Tensor rows of the given participant IDs (-1 for IDs the tensor does not know), in order
+def participant_rows(root: str, participant_ids: list[str]) -> np.ndarray:
+    lookup = pl.read_parquet(f"{root}/participant.parquet").rename({"id": "participantId"})
+    rows = pl.DataFrame({"participantId": participant_ids}).join(lookup, on="participantId", how="left", maintain_order="left")
+    return rows["key"].cast(pl.Int64).fill_null(-1).to_numpy()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from hashlib import sha256
+from typing import Callable
+
+import polars as pl
+from loguru import logger
+
+# Content-addressed cache for derived lookup tables (processed scores, CRH flags, condensed topics, ...).
+# An artifact's key hashes its name, its build parameters and the contents of its input files, so a cached table is
+# reused by any run or notebook that asks for the same thing and silently goes stale when an input changes.
+# The cache directory is kept under a size budget by evicting the least recently used artifacts.
+
+CACHE_DIR = "data/cache"
+MAX_CACHE_BYTES = 4 * 1024**3
+
+# Content hashes of input files, remembered by (size, mtime) so unchanged multi-GB inputs are only read once
+_FINGERPRINTS = f"{CACHE_DIR}/_fingerprints.json"
+
+
+# Stages run in threads and look up fingerprints concurrently; the read-modify-write of the file is serialized
+_FINGERPRINTS_LOCK = threading.Lock()
+# Likewise for artifacts: a hit's refresh and read and an eviction pass never interleave between a run's threads
+_ARTIFACTS_LOCK = threading.Lock()
+
+
+def _read_fingerprints() -> dict:
+    if not os.path.exists(_FINGERPRINTS):
+        return {}
+    with open(_FINGERPRINTS) as f:
+        return json.load(f)
+
+
+def _file_digest(path: str) -> str:
+    stat = os.stat(path)
+    with _FINGERPRINTS_LOCK:
+        entry = _read_fingerprints().get(os.path.abspath(path))
+    if entry is not None and entry["size"] == stat.st_size and entry["mtimeNs"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    # Hashed outside the lock, so several large inputs are read in parallel
+    digest = sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 24):
+            digest.update(chunk)
+    with _FINGERPRINTS_LOCK:
+        known = _read_fingerprints()
+        known[os.path.abspath(path)] = {"size": stat.st_size, "mtimeNs": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Replaced atomically, so readers (also in other processes) never see a partly written file
+        tmp = f"{_FINGERPRINTS}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(known, f)
+        os.replace(tmp, _FINGERPRINTS)
+    return digest.hexdigest()
+
+
+def artifact_key(name: str, inputs: list[str], params: dict) -> str:
+    digest = sha256(name.encode("utf-8"))
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    for path in inputs:
+        digest.update(_file_digest(path).encode("utf-8"))
+    return digest.hexdigest()[:24]
+
+
+# Evict least recently used artifacts (by mtime, which hits refresh) until the cache fits in `max_bytes`. Artifacts
+# removed since the scan (by another run pruning the same cache) are skipped.
+def evict(max_bytes: int = MAX_CACHE_BYTES) -> None:
+    artifacts = []
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.name.endswith(".parquet"):
+            continue
+        try:
+            artifacts.append((entry.stat().st_mtime, entry.stat().st_size, entry))
+        except FileNotFoundError:
+            continue
+    artifacts.sort(key=lambda artifact: artifact[0])
+    total = sum(size for _, size, _ in artifacts)
+    for _, size, entry in artifacts:
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        logger.debug(f"Evicted cached artifact {entry.name}")
+
+
+def cached(
+    name: str, inputs: list[str], params: dict, build: Callable[[], pl.DataFrame], max_bytes: int = MAX_CACHE_BYTES,
+) -> pl.DataFrame:
+    path = f"{CACHE_DIR}/{name}-{artifact_key(name, inputs, params)}.parquet"
+    # An artifact evicted between the lookup and the read is rebuilt rather than failing the run
+    try:
+        with _ARTIFACTS_LOCK:
+            os.utime(path)
+            artifact = pl.read_parquet(path)
+    except FileNotFoundError:
+        pass
+    else:
+        logger.info(f"Loaded {name} from cache")
+        return artifact
+
+    artifact = build()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Threads building the same artifact each write their own temporary file
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    artifact.write_parquet(tmp)
+    os.replace(tmp, path)
+    logger.info(f"Built and cached {name} ({len(artifact):,} rows)")
+    with _ARTIFACTS_LOCK:
+        evict(max_bytes)
+    return artifact
@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from argparse import Namespace
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import numpy as np
+import polars as pl
+from loguru import logger
+
+from instrumentation import log_summary_at_exit
+
+# Offline benchmark for the trajectory build. Generates synthetic notes, ratings, requests, scored notes, status
+# records, topics and partisanship labels with the shapes create_trajectories.py expects, runs the enrichment and
+# aggregation stages on them, and appends per-stage timings to a JSON-lines history so runs can be compared.
+#
+#   python processing/benchmark_trajectories.py --sizes 1M 10M
+#
+# Generated inputs are kept under --workdir and reused by later runs of the same size and seed. Stages run one at a
+# time by default so each stage's wall time is its own; pass --workers to benchmark the concurrent schedule instead.
+# Ratings are generated and written in chunks, but the build itself runs eagerly, so 100M needs a machine sized for it.
+
+SIZES = {"1M": 1_000_000, "10M": 10_000_000, "100M": 100_000_000}
+_CHUNK_ROWS = 5_000_000
+_START_MILLIS, _END_MILLIS = 1_611_000_000_000, 1_770_000_000_000  # Jan 2021 (launch) to Feb 2026
+
+_MODELS = [
+    "CoreModel (v1.1)", "ExpansionModel (v1.1)", "ExpansionPlusModel (v1.1)", "GroupModel03 (v1.1)",
+    "MultiGroupModel01 (v1.0)", "TopicModel02 (v1.0)", "ScoringDriftGuard (v1.0)", "InsufficientExplanation (v1.0)",
+]
+_MODEL_PREFIXES = ["core", "expansion", "expansionPlus", "group", "multiGroup", "topic"]
+_TOPICS = ["sports", "diaries_&_daily_life", "business_&_entrepreneurs", "science_&_technology", "news_&_social_concern", "music", "film_tv_&_video"]
+
+
+def _hex_ids(rng: np.random.Generator, n: int) -> np.ndarray:
+    return np.array([f"{i:016X}" * 4 for i in rng.integers(0, 2**63, n)])
+
+
+# Write every input of one synthetic snapshot under `root`, at the same relative paths create_trajectories.py reads.
+# Activity is heavy-tailed: a Pareto-weighted core of users produces most notes, ratings and requests (a small
+# hyperactive-rater tail among them), and a separate crowd of one-shot users rates exactly once.
+def generate(root: str, n_ratings: int, seed: int = 0) -> None:
+    import create_trajectories as ct
+
+    rng = np.random.default_rng(seed)
+    n_users, n_one_shot, n_notes = max(n_ratings // 40, 100), max(n_ratings // 50, 10), max(n_ratings // 30, 50)
+    n_requests = max(n_ratings // 10, 10)
+    for path in (ct._NOTES_PATH, ct._RATINGS_PATH, ct._REQUESTS_PATH, ct._SCORES_PATH, ct._TOPICS_PATH):
+        os.makedirs(os.path.dirname(f"{root}/{path}"), exist_ok=True)
+
+    users, one_shot_users = _hex_ids(rng, n_users), _hex_ids(rng, n_one_shot)
+    weights = rng.pareto(1.1, n_users) + 1
+    weights /= weights.sum()
+
+    note_ids = np.sort(rng.choice(2 * 10**18, n_notes, replace=False)).astype(np.int64)
+    note_created = rng.integers(_START_MILLIS, _END_MILLIS, n_notes)
+    tweet_ids = rng.integers(10**18, 2 * 10**18, max(n_notes // 2, 1))
+    pl.DataFrame({
+        "noteId": note_ids,
+        "noteAuthorParticipantId": users[rng.choice(n_users, n_notes, p=weights)],
+        "createdAtMillis": note_created,
+        "tweetId": rng.choice(tweet_ids, n_notes),
+        "classification": rng.choice(["MISINFORMED_OR_POTENTIALLY_MISLEADING", "NOT_MISLEADING"], n_notes, p=[0.85, 0.15]),
+        "summary": rng.choice(["Context: see source.", "This claim is missing context."], n_notes),
+    }).write_parquet(f"{root}/{ct._NOTES_PATH}")
+
+    # Ratings go through one file per chunk, streamed into the final file, so generation memory stays flat
+    chunk_dir = f"{root}/_rating_chunks"
+    os.makedirs(chunk_dir, exist_ok=True)
+    for i, start in enumerate(range(0, n_ratings, _CHUNK_ROWS)):
+        n = min(_CHUNK_ROWS, n_ratings - start)
+        note_index = rng.integers(0, n_notes, n)
+        raters = users[rng.choice(n_users, n, p=weights)]
+        if start == 0:
+            raters[rng.choice(n, min(n_one_shot, n), replace=False)] = one_shot_users[:n]
+        pl.DataFrame({
+            "noteId": note_ids[note_index],
+            "raterParticipantId": raters,
+            # Most ratings arrive within a day or two of the note, with a long tail
+            "createdAtMillis": note_created[note_index] + rng.exponential(1.5 * 86_400_000, n).astype(np.int64),
+            "version": np.full(n, 2, dtype=np.int64),
+            "agree": rng.integers(0, 2, n),
+            "helpfulnessLevel": rng.choice(["HELPFUL", "SOMEWHAT_HELPFUL", "NOT_HELPFUL", None], n, p=[0.45, 0.15, 0.35, 0.05]),
+            **{f"helpful{reason}": rng.integers(0, 2, n) for reason in ("Clear", "GoodSources", "AddressesClaim", "ImportantContext")},
+            **{f"notHelpful{reason}": rng.integers(0, 2, n) for reason in ("Incorrect", "SourcesMissingOrUnreliable", "MissingKeyPoints")},
+        }).write_parquet(f"{chunk_dir}/{i:05d}.parquet")
+    pl.scan_parquet(f"{chunk_dir}/*.parquet").sink_parquet(f"{root}/{ct._RATINGS_PATH}", engine="streaming")
+    shutil.rmtree(chunk_dir)
+
+    pl.DataFrame({
+        "userId": users[rng.choice(n_users, n_requests, p=weights)],
+        "tweetId": rng.choice(tweet_ids, n_requests),
+        "createdAtMillis": rng.integers(_START_MILLIS, _END_MILLIS, n_requests),
+    }).write_parquet(f"{root}/{ct._REQUESTS_PATH}")
+
+    decided_by = rng.choice(np.array([*_MODELS, None], dtype=object), n_notes)
+    drift_model = rng.choice(_MODELS[:6], n_notes)
+    pl.DataFrame({
+        "noteId": note_ids,
+        "createdAtMillis": note_created,
+        "decidedBy": list(decided_by),
+        "metaScorerActiveRules": [
+            f"CoreModel (v1.1),{model},ScoringDriftGuard (v1.0)" if decided == "ScoringDriftGuard (v1.0)" else None
+            for decided, model in zip(decided_by, drift_model)
+        ],
+        "finalRatingStatus": rng.choice(["CURRENTLY_RATED_HELPFUL", "CURRENTLY_RATED_NOT_HELPFUL", "NEEDS_MORE_RATINGS"], n_notes, p=[0.1, 0.05, 0.85]),
+        "numRatings": rng.integers(0, 500, n_notes),
+        **{f"{prefix}NoteIntercept": rng.normal(0, 0.2, n_notes) for prefix in _MODEL_PREFIXES},
+        **{f"{prefix}NoteFactor1": rng.normal(0, 0.5, n_notes) for prefix in _MODEL_PREFIXES},
+    }).write_parquet(f"{root}/{ct._SCORES_PATH}")
+
+    n_statuses = 2 * n_notes
+    pl.DataFrame({
+        "note_id": note_ids[rng.integers(0, n_notes, n_statuses)],
+        "status": rng.choice(["NEEDS_MORE_RATINGS", "CURRENTLY_RATED_HELPFUL", "CURRENTLY_RATED_NOT_HELPFUL"], n_statuses),
+        "status_time": pl.Series(rng.integers(_START_MILLIS, _END_MILLIS + 10**10, n_statuses))
+            .cast(pl.Datetime("ms")).dt.replace_time_zone("UTC").dt.strftime("%Y-%m-%dT%H:%M:%S%.3f%z"),
+    }).write_csv(f"{root}/{ct._STATUSES_PATH}")
+
+    has_topic = rng.random(n_notes) < 0.8
+    pl.DataFrame({
+        "noteId": note_ids[has_topic], "topic": rng.choice(_TOPICS, int(has_topic.sum())),
+    }).write_parquet(f"{root}/{ct._TOPICS_PATH}")
+
+    has_party = rng.random(n_notes) < 0.3
+    pl.DataFrame({
+        "note_id": note_ids[has_party], "party": rng.choice(["democrat", "republican"], int(has_party.sum())),
+    }).write_csv(f"{root}/{ct._PARTISANSHIP_PATH}")
+    logger.info(f"Generated {n_ratings:,} ratings from {n_users + n_one_shot:,} users on {n_notes:,} notes in {root}")
+
+
+# Run the enrichment and aggregation stages once in `root` and return their stats by stage name
+def run_build(root: str, workers: int, intern_ids: bool, cache: bool) -> dict[str, dict]:
+    import create_trajectories as ct
+    from stage_dag import run_stages
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        args = Namespace(lazy=False, intern_ids=intern_ids, no_cache=not cache, spill_buckets=None, session_gaps=ct.SESSION_GAPS_MINUTES)
+        _, timings = run_stages(
+            ct._trajectory_stages(args, pl.lit(True)), initial={"raw_prior_first_action": None}, max_workers=workers,
+        )
+    finally:
+        os.chdir(cwd)
+    return {stats.name: {key: value for key, value in asdict(stats).items() if key not in ("name", "started")} for stats in timings}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Append `run` to the history and log how each stage compares to the last run with the same size and options
+def record(history_path: str, run: dict, threshold: float = 1.2) -> None:
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    comparable = [past for past in history if past["size"] == run["size"] and past["options"] == run["options"]]
+
+    if comparable:
+        previous = comparable[-1]
+        logger.info(f"Comparing {run['size']} against the run at {previous['timestamp']} (commit {previous['commit'] or 'unknown'})")
+        for name, stats in run["stages"].items():
+            before = previous["stages"].get(name, {}).get("wall_seconds")
+            # Stages this short are mostly noise
+            if before is None or before < 0.05:
+                continue
+            ratio = stats["wall_seconds"] / before
+            log = logger.warning if ratio > threshold else logger.info
+            log(f"  {name}: {before:.2f}s -> {stats['wall_seconds']:.2f}s ({ratio:.2f}x)")
+
+    os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+    with open(history_path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the trajectory build on synthetic Community Notes data.")
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["1M"], help="Numbers of synthetic ratings to benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per size; each is recorded separately")
+    parser.add_argument("--workers", type=int, default=1, help="Stages allowed to run at once (1 times each stage on its own)")
+    parser.add_argument("--intern-ids", action="store_true", help="Benchmark the build on interned integer IDs")
+    parser.add_argument("--cache", action="store_true", help="Reuse cached reference tables instead of timing their construction")
+    parser.add_argument("--workdir", default="data/benchmark", help="Where synthetic inputs are generated and kept")
+    parser.add_argument("--history", default="data/benchmark_history.jsonl")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    log_summary_at_exit()
+    history_path = os.path.abspath(args.history)
+    options = {"seed": args.seed, "workers": args.workers, "internIds": args.intern_ids, "cache": args.cache}
+
+    for size in args.sizes:
+        root = os.path.abspath(f"{args.workdir}/{size}-seed{args.seed}")
+        if not os.path.exists(f"{root}/_complete"):
+            shutil.rmtree(root, ignore_errors=True)
+            generate(root, SIZES[size], args.seed)
+            open(f"{root}/_complete", "w").close()
+
+        for _ in range(args.repeat):
+            stages = run_build(root, args.workers, args.intern_ids, args.cache)
+            run = {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "commit": _git_commit(),
+                "size": size,
+                "options": options,
+                "python": sys.version.split()[0],
+                "polars": pl.__version__,
+                "cpus": os.cpu_count(),
+                "totalWallSeconds": sum(stats["wall_seconds"] for stats in stages.values()),
+                "stages": stages,
+            }
+            record(history_path, run)
+            logger.info(f"{size}: stages took {run['totalWallSeconds']:.2f}s in total")
@@ -0,0 +1,34 @@
+import argparse
+
+import polars as pl
+from loguru import logger
+
+# One-time conversion of a note status records CSV (note_id, status, status_time) into typed Parquet:
+#   - status_time strings become Int64 epoch milliseconds (status_time_millis), parsed once instead of every build
+#   - status becomes Categorical
+#   - rows are sorted by time, so row-group statistics let a date cutoff skip everything after it
+# create_trajectories.py picks the Parquet file up automatically when it sits next to the CSV.
+#
+#   python processing/convert_status_records.py data/2026-02-27-note_status_records.csv
+
+
+def convert_status_records(csv_path: str, parquet_path: str) -> None:
+    (
+        pl.scan_csv(csv_path)
+        .select(
+            "note_id",
+            pl.col("status").cast(pl.Categorical),
+            status_time_millis=pl.col("status_time").str.to_datetime("%Y-%m-%dT%H:%M:%S%.f%z").dt.epoch("ms"),
+        )
+        .sort("status_time_millis")
+        .sink_parquet(parquet_path, row_group_size=250_000, engine="streaming")
+    )
+    logger.info(f"Converted {csv_path} to {parquet_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a note status records CSV into typed, time-sorted Parquet.")
+    parser.add_argument("csv_path")
+    parser.add_argument("parquet_path", nargs="?", help="Defaults to the CSV path with a .parquet extension")
+    args = parser.parse_args()
+    convert_status_records(args.csv_path, args.parquet_path or args.csv_path.removesuffix(".csv") + ".parquet")
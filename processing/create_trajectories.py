@@ -1,8 +1,28 @@
-from hashlib import md5
+import argparse
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha256
+from multiprocessing import get_context
+from typing import Callable, TypeVar
 
 import polars as pl
 from loguru import logger
 
+from activity_tensor import LAYOUTS, write_activity_tensor
+from artifact_cache import cached
+from id_interning import decode, encode, extend_lookup, load_lookup, save_lookup
+from instrumentation import log_summary_at_exit, measure
+from participant_panel import build_panel
+from rating_sessions import SESSION_GAPS_MINUTES, monthly_session_aggregates
+from stage_dag import Stage, run_stages
+from trajectory_store import PARTITION_KEYS, write_partitioned
+from user_sampling import id_digest, in_sample, sample_assignments, write_samples
+
 logger.add("logs/create_trajectories.log", rotation="10 MB", level="DEBUG", serialize=True)
 
 # Reusable filter expressions for rating aggregations
@@ -19,10 +39,94 @@ _never_crh = ~pl.col("noteEverCrh")
 
 _top_5_topics = ["sports", "diaries_&_daily_life", "business_&_entrepreneurs", "science_&_technology", "news_&_social_concern"]
 
+# Action data
+_NOTES_PATH         = "data/2026-02-03/notes.parquet"
+_RATINGS_PATH       = "data/2026-02-03/noteRatings.parquet"
+_REQUESTS_PATH      = "data/2026-01-09/noteRequests.parquet"
+
+# Reference inputs for the enrichments
+_SCORES_PATH        = "data/2026-02-03-scored_notes.parquet"
+_STATUSES_PATH      = "data/2026-02-27-note_status_records.csv"     # Processed statuses, taken from a scm-prep run on 2/27.
+_STATUSES_PARQUET   = _STATUSES_PATH.removesuffix(".csv") + ".parquet"  # Typed copy written by convert_status_records.py
+_TOPICS_PATH        = "data/from-soham-notes_full.parquet"
+_PARTISANSHIP_PATH  = "data/renault_partisanship_labels.csv"         # Partisanship data is from paper: "Republicans are flagged more often than Democrats for sharing misinformation on X's Community Notes" by Renault et al.
+_CRH_CUTOFF         = (2026, 2, 3)                                  # Statuses after the notes/ratings snapshot are ignored
+
+# Intercept and factor columns written by each scoring model
+_I_AND_F_COLUMNS = {
+    "CoreModel (v1.1)": ("coreNoteIntercept", "coreNoteFactor1"),
+    "ExpansionModel (v1.1)": ("expansionNoteIntercept", "expansionNoteFactor1"),
+    "ExpansionPlusModel (v1.1)": ("expansionPlusNoteIntercept", "expansionPlusNoteFactor1"),
+    "GroupModel01 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel02 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel03 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel04 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel05 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel06 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel07 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel08 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel09 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel10 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel11 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel12 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel13 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "GroupModel14 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
+    "MultiGroupModel01 (v1.0)": ("multiGroupNoteIntercept", "multiGroupNoteFactor1"),
+    "TopicModel01 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
+    "TopicModel02 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
+    "TopicModel03 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
+    "ScoringDriftGuard (v1.0)": (None, None),
+    "NmrDueToMinStableCrhTime (v1.0)": (None, None),
+    "InsufficientExplanation (v1.0)": (None, None),
+}
+
+# Trajectory files and the participant column each one is keyed by
+_NOTE_TRAJ, _RATING_TRAJ, _REQUEST_TRAJ = "data/user_note_traj.parquet", "data/user_rating_traj.parquet", "data/user_request_traj.parquet"
+_TRAJ_ID_COLUMNS = {_NOTE_TRAJ: "noteAuthorParticipantId", _RATING_TRAJ: "raterParticipantId", _REQUEST_TRAJ: "requesterParticipantId"}
+_SAMPLE_PATHS = {
+    _NOTE_TRAJ: "data/sample_user_note_traj.parquet", _RATING_TRAJ: "data/sample_user_rating_traj.parquet", _REQUEST_TRAJ: "data/sample_user_request_traj.parquet",
+}
+
+# Combined participant-month panel, a hive-partitioned directory like the --partition-by trajectories
+_PANEL_DIR = "data/user_panel"
+
+# Per-participant state persisted between incremental runs
+_STATE_DIR = "data/trajectory_state"
+
+# Every enrichment step accepts and returns either eager DataFrames or LazyFrames
+Frame = TypeVar("Frame", pl.DataFrame, pl.LazyFrame)
+
+
+# Reference tables follow the mode of the frames they enrich, so lazy runs never materialize them
+def _read_like(frame: pl.DataFrame | pl.LazyFrame, source: pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    return source if isinstance(frame, pl.LazyFrame) else source.collect()
+
+
+# Derived reference table for `frame`'s mode. With `cache`, the table is materialized once per distinct input content
+# and parameters and reused across runs; otherwise it is planned from the raw input every time. The key also covers the
+# source of `table`, so changing how a table is derived rebuilds it rather than reusing a copy built the old way.
+# Reference tables are keyed by raw note ids, so when ids are interned they are mapped to the same keys as notes and
+# ratings.
+def _reference(
+    frame: pl.DataFrame | pl.LazyFrame, name: str, inputs: list[str], params: dict, table: Callable[[], pl.LazyFrame],
+    note_id_column: str, note_ids: pl.DataFrame | None, cache: bool,
+) -> pl.DataFrame | pl.LazyFrame:
+    if cache:
+        params = params | {"builder": sha256(inspect.getsource(table).encode("utf-8")).hexdigest()}
+        source = cached(name, inputs, params, lambda: table().collect()).lazy()
+    else:
+        source = table()
+    source = source if note_ids is None else encode(source, note_id_column, note_ids, how="inner")
+    return _read_like(frame, source)
+
+
+# Row counts are only logged when they are free, i.e. when the frame is already materialized
+def _count(frame: pl.DataFrame | pl.LazyFrame) -> str:
+    return f"{len(frame):,}" if isinstance(frame, pl.DataFrame) else "(deferred)"
 
 
 # Calculate calendar-based user month (months since first action) and calendar month
-def _enrich_with_user_and_calendar_month(df: pl.DataFrame) -> pl.DataFrame:
+def _enrich_with_user_and_calendar_month(df: Frame) -> Frame:
     return df.with_columns(
         _actionDt=pl.from_epoch(pl.col("createdAtMillis"), time_unit="ms"),
         _firstActionDt=pl.from_epoch(pl.col("participantFirstActionMillis"), time_unit="ms"),
@@ -35,36 +139,11 @@ def _enrich_with_user_and_calendar_month(df: pl.DataFrame) -> pl.DataFrame:
     ).drop("_actionDt", "_firstActionDt")
 
 
-def _enrich_with_scores(
-    notes: pl.DataFrame, ratings: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame]:
-    scores      = pl.read_parquet("data/2026-02-03-scored_notes.parquet")
-    I_AND_F_COLUMNS = {
-        "CoreModel (v1.1)": ("coreNoteIntercept", "coreNoteFactor1"),
-        "ExpansionModel (v1.1)": ("expansionNoteIntercept", "expansionNoteFactor1"),
-        "ExpansionPlusModel (v1.1)": ("expansionPlusNoteIntercept", "expansionPlusNoteFactor1"),
-        "GroupModel01 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel02 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel03 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel04 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel05 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel06 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel07 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel08 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel09 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel10 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel11 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel12 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel13 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "GroupModel14 (v1.1)": ("groupNoteIntercept", "groupNoteFactor1"),
-        "MultiGroupModel01 (v1.0)": ("multiGroupNoteIntercept", "multiGroupNoteFactor1"),
-        "TopicModel01 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
-        "TopicModel02 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
-        "TopicModel03 (v1.0)": ("topicNoteIntercept", "topicNoteFactor1"),
-        "ScoringDriftGuard (v1.0)": (None, None),
-        "NmrDueToMinStableCrhTime (v1.0)": (None, None),
-        "InsufficientExplanation (v1.0)": (None, None),
-    }
+def _scores_table() -> pl.LazyFrame:
+    scores = pl.scan_parquet(_SCORES_PATH)
+
+    # Distinct (intercept, factor) column pairs; a model's family is the position of its pair in this list
+    families = list(dict.fromkeys(cols for cols in _I_AND_F_COLUMNS.values() if cols != (None, None)))
 
     scores = (
         scores
@@ -75,45 +154,76 @@ def _enrich_with_scores(
                             .then(pl.col("metaScorerActiveRules").str.split(",").list[-2])
                             .otherwise(pl.col("decidedBy"))
         )
-        # Retrieve the intercept from the inferred model
+    )
+    # Prefix-match each distinct model name once, rather than every model prefix against every scored note
+    model_families = (
+        scores
+        .select(pl.col("preDriftModel").drop_nulls().unique())
+        .with_columns(_modelFamily=pl.coalesce([
+            pl.when(pl.col("preDriftModel").str.starts_with(prefix))
+              .then(pl.lit(families.index(cols), dtype=pl.UInt8))
+            for prefix, cols in _I_AND_F_COLUMNS.items()
+            if cols != (None, None)
+        ]))
+    )
+    return (
+        scores
+        # Retrieve the intercept and factor from the inferred model's column family
+        .join(model_families, on="preDriftModel", how="left", validate="m:1")
         .with_columns(
-            noteFinalIntercept=pl.coalesce([
-                pl.when(pl.col("preDriftModel").str.starts_with(prefix))
-                  .then(pl.col(intercept_col))
-                for prefix, (intercept_col, _) in I_AND_F_COLUMNS.items()
-                if intercept_col is not None
-            ]),
-            # Retrieve the factor from the inferred model
-            noteFinalFactor=pl.coalesce([
-                pl.when(pl.col("preDriftModel").str.starts_with(prefix))
-                  .then(pl.col(factor_col))
-                for prefix, (_, factor_col) in I_AND_F_COLUMNS.items()
-                if factor_col is not None
-            ]),
+            noteFinalIntercept=pl.concat_list([intercept_col for intercept_col, _ in families]).list.get(pl.col("_modelFamily"), null_on_oob=True),
+            noteFinalFactor   =pl.concat_list([factor_col    for _, factor_col    in families]).list.get(pl.col("_modelFamily"), null_on_oob=True),
         )
         .rename({"finalRatingStatus": "noteFinalRatingStatus"})
         .select("noteId", "noteFinalRatingStatus", "numRatings", "decidedBy", "noteFinalIntercept", "noteFinalFactor")
     )
 
+
+def _enrich_with_scores(
+    notes: Frame, ratings: Frame, scores: Frame,
+) -> tuple[Frame, Frame]:
     notes = notes.join(scores, on="noteId", how="left", coalesce=True, validate="1:1")
     ratings = ratings.join(scores, on="noteId", how="left", coalesce=True, validate="m:1")
     logger.info("Enriched notes and ratings with scores and factors")
     return notes, ratings
 
 
-def _enrich_with_crh(
-    notes: pl.DataFrame, ratings: pl.DataFrame, requests: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
-    statuses    = pl.read_csv    ("data/2026-02-27-note_status_records.csv")    # Processed statuses, taken from a scm-prep run on 2/27.
-    # Calculate whether a note ever achieved CRH status
-    note_ever_crh = (
+# The typed Parquet copy of the status records when it is at least as new as the raw CSV, the CSV otherwise
+def _statuses_input() -> str:
+    if not os.path.exists(_STATUSES_PARQUET):
+        return _STATUSES_PATH
+    if os.path.exists(_STATUSES_PATH) and os.path.getmtime(_STATUSES_PARQUET) < os.path.getmtime(_STATUSES_PATH):
+        logger.warning(
+            f"{_STATUSES_PARQUET} is older than {_STATUSES_PATH}, reading the CSV instead; "
+            f"re-run processing/convert_status_records.py {_STATUSES_PATH} to refresh it"
+        )
+        return _STATUSES_PATH
+    return _STATUSES_PARQUET
+
+
+# Calculate whether a note ever achieved CRH status
+def _note_ever_crh_table() -> pl.LazyFrame:
+    if _statuses_input() == _STATUSES_PARQUET:
+        # Pre-parsed and time-sorted: the cutoff is an integer comparison that row-group statistics can prune on
+        cutoff_millis = int(datetime(*_CRH_CUTOFF, tzinfo=timezone.utc).timestamp() * 1000)
+        statuses = pl.scan_parquet(_STATUSES_PARQUET).filter(pl.col("status_time_millis") <= cutoff_millis)
+    else:
+        statuses = (
+            pl.scan_csv(_STATUSES_PATH)
+            .with_columns(status_time=pl.col("status_time").str.to_datetime("%Y-%m-%dT%H:%M:%S%.f%z"))
+            .filter(pl.col("status_time") <= pl.datetime(*_CRH_CUTOFF, time_zone="UTC"))
+        )
+    return (
         statuses
-        .with_columns(status_time=pl.col("status_time").str.to_datetime("%Y-%m-%dT%H:%M:%S%.f%z"))
-        .filter(pl.col("status_time") <= pl.datetime(2026, 2, 3, time_zone="UTC"))
         .with_columns(Crh = pl.col("status") == "CURRENTLY_RATED_HELPFUL")
         .group_by("note_id")
         .agg(noteEverCrh = pl.col("Crh").any())
     )
+
+
+def _enrich_with_crh(
+    notes: Frame, ratings: Frame, requests: Frame, note_ever_crh: Frame,
+) -> tuple[Frame, Frame, Frame]:
     post_ever_crh = (
         notes
         .select("noteId", "tweetId")
@@ -121,8 +231,8 @@ def _enrich_with_crh(
         .group_by("tweetId")
         .agg(postEverCrh=pl.col("noteEverCrh").fill_null(False).any())
     )
-    logger.info(f"Calculated CRH statuses for {len(note_ever_crh):,} notes")
-    logger.info(f"Calculated CRH statuses for {len(post_ever_crh):,} posts")
+    logger.info(f"Calculated CRH statuses for {_count(note_ever_crh)} notes")
+    logger.info(f"Calculated CRH statuses for {_count(post_ever_crh)} posts")
 
     notes    = notes   .join(note_ever_crh, left_on="noteId", right_on="note_id", how="left", coalesce=True, validate="1:1")
     ratings  = ratings .join(note_ever_crh, left_on="noteId", right_on="note_id", how="left", coalesce=True, validate="m:1")
@@ -131,14 +241,16 @@ def _enrich_with_crh(
     return notes, ratings, requests
 
 
-def _enrich_with_topics(
-    notes: pl.DataFrame, ratings: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame]:
+def _topics_table() -> pl.LazyFrame:
     # Join anything outside to top 5 topics into "other"
-    topics      = pl.read_parquet("data/from-soham-notes_full.parquet")
+    topics = pl.scan_parquet(_TOPICS_PATH)
     topics = topics.with_columns(condensed_topic=pl.when(pl.col("topic").is_in(_top_5_topics)).then(pl.col("topic")).otherwise(pl.lit("other")))
-    topics = topics.select("noteId", "topic", "condensed_topic")
+    return topics.select("noteId", "topic", "condensed_topic")
 
+
+def _enrich_with_topics(
+    notes: Frame, ratings: Frame, topics: Frame,
+) -> tuple[Frame, Frame]:
     notes   = notes  .join(topics, on="noteId", how="left", validate="1:1")  # TODO: Get more recent data from soham
     ratings = ratings.join(topics, on="noteId", how="left", validate="m:1")
     logger.info("Enriched notes and ratings with topics")
@@ -146,36 +258,42 @@ def _enrich_with_topics(
     return notes, ratings
 
 
-def _enrich_with_first_action(
-    notes: pl.DataFrame, ratings: pl.DataFrame, requests: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
-    first_note_written      = notes     .group_by("noteAuthorParticipantId").agg(createdAtMillis=pl.col("createdAtMillis").min())
-    first_note_rated        = ratings   .group_by("raterParticipantId")     .agg(createdAtMillis=pl.col("createdAtMillis").min())
-    first_note_requested    = requests  .group_by("requesterParticipantId") .agg(createdAtMillis=pl.col("createdAtMillis").min())
+# Earliest action per participant in one table (e.g. first_note_written from notes by noteAuthorParticipantId)
+def _first_action_of(frame: Frame, participant_column: str) -> Frame:
+    return frame.group_by(participant_column).agg(createdAtMillis=pl.col("createdAtMillis").min()).rename({participant_column: "participantId"})
+
+
+def _combine_first_actions(
+    first_note_written: Frame, first_note_rated: Frame, first_note_requested: Frame, prior_first_action: Frame | None = None,
+) -> Frame:
+    # Incremental runs only see recent actions, so earlier first actions come from the persisted state
+    first_prior = [] if prior_first_action is None else [prior_first_action.rename({"participantFirstActionMillis": "createdAtMillis"})]
     first_action = (
-        pl.concat([
-            first_note_written  .rename({"noteAuthorParticipantId": "participantId"}),
-            first_note_rated    .rename({"raterParticipantId":      "participantId"}),
-            first_note_requested.rename({"requesterParticipantId":  "participantId"}),
-        ])
+        pl.concat([first_note_written, first_note_rated, first_note_requested, *first_prior])
         .group_by("participantId")
         .agg(participantFirstActionMillis=pl.col("createdAtMillis").min())
     )
-    logger.info(f"First action calculated for {len(first_action):,} users")
+    logger.info(f"First action calculated for {_count(first_action)} users")
+    return first_action
 
 
+def _enrich_with_first_action(
+    notes: Frame, ratings: Frame, requests: Frame, first_action: Frame,
+) -> tuple[Frame, Frame, Frame]:
     notes    = notes   .join(first_action.rename({"participantId": "noteAuthorParticipantId"}),on="noteAuthorParticipantId",   how="left", validate="m:1")
     ratings  = ratings .join(first_action.rename({"participantId": "raterParticipantId"}),     on="raterParticipantId",        how="left", validate="m:1")
     requests = requests.join(first_action.rename({"participantId": "requesterParticipantId"}), on="requesterParticipantId",    how="left", validate="m:1")
     logger.info("Enriched notes and ratings with user join dates")
-    return notes, ratings, requests, first_action
+    return notes, ratings, requests
+
+
+def _partisanship_table() -> pl.LazyFrame:
+    return pl.scan_csv(_PARTISANSHIP_PATH).select("note_id", "party").rename({"party": "postAuthorParty"})
 
 
 def _enrich_with_partisanship(
-    notes: pl.DataFrame, ratings: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame]:
-    partisanship= pl.read_csv("data/renault_partisanship_labels.csv") # Partisanship data is from paper: "Republicans are flagged more often than Democrats for sharing misinformation on X's Community Notes" by Renault et al.
-    party_cols = partisanship.select("note_id", "party").rename({"party": "postAuthorParty"})
+    notes: Frame, ratings: Frame, party_cols: Frame,
+) -> tuple[Frame, Frame]:
     notes   = notes  .join(party_cols, left_on="noteId", right_on="note_id", coalesce=True, how="left", validate="1:1")
     ratings = ratings.join(party_cols, left_on="noteId", right_on="note_id", coalesce=True, how="left", validate="m:1")
     # TODO: Partisanship for note requests?
@@ -184,8 +302,8 @@ def _enrich_with_partisanship(
 
 
 def _enrich_ratings_with_note_data(
-    ratings: pl.DataFrame, notes: pl.DataFrame,
-) -> pl.DataFrame:
+    ratings: Frame, notes: Frame,
+) -> Frame:
     ratings = ratings.join(
         notes.select("noteId", "noteEverCrh", "noteFinalFactor", "noteFinalIntercept", "topic", "postAuthorParty", "classification"),
         on="noteId",
@@ -197,8 +315,8 @@ def _enrich_ratings_with_note_data(
 
 
 def _enrich_requests_with_outcomes(
-    requests: pl.DataFrame, notes: pl.DataFrame,
-) -> pl.DataFrame:
+    requests: Frame, notes: Frame,
+) -> Frame:
     request_outcomes = (
         notes
         .select("tweetId", "noteEverCrh")
@@ -214,34 +332,9 @@ def _enrich_requests_with_outcomes(
     return requests
 
 
-if __name__ == "__main__":
-    # Load data
-    users       = pl.read_parquet("data/2026-02-03/userEnrollment.parquet")
-    notes       = pl.read_parquet("data/2026-02-03/notes.parquet")
-    ratings     = pl.read_parquet("data/2026-02-03/noteRatings.parquet")
-    requests    = pl.read_parquet("data/2026-01-09/noteRequests.parquet").rename({"userId": "requesterParticipantId"}) # Using the user-level requests, not post-level requests!
-    logger.info("Data loaded successfully")
-    
-    ratings  = ratings .with_columns(ratingDate= pl.from_epoch(pl.col("createdAtMillis"), time_unit="ms").dt.date())
-    requests = requests.with_columns(requestDate=pl.from_epoch(pl.col("createdAtMillis"), time_unit="ms").dt.date())
-
-    # Enrich
-    notes, ratings = _enrich_with_scores(notes, ratings)
-    notes, ratings, requests = _enrich_with_crh(notes, ratings, requests)
-    notes, ratings = _enrich_with_topics(notes, ratings)
-    notes, ratings, requests, first_action = _enrich_with_first_action(notes, ratings, requests)
-
-    notes    = _enrich_with_user_and_calendar_month(notes)
-    ratings  = _enrich_with_user_and_calendar_month(ratings)
-    requests = _enrich_with_user_and_calendar_month(requests)
-    logger.info("Calculated user months and calendar months")
-
-    notes, ratings = _enrich_with_partisanship(notes, ratings)
-    ratings = _enrich_ratings_with_note_data(ratings, notes)
-    requests = _enrich_requests_with_outcomes(requests, notes)
-
-    # Aggregate all users' notes per month
-    user_notes = notes.group_by(["noteAuthorParticipantId", "userMonth"]).agg(
+# Aggregate all users' notes per month
+def _aggregate_user_notes(notes: Frame) -> Frame:
+    return notes.group_by(["noteAuthorParticipantId", "userMonth"]).agg(
         calendarMonth=pl.col("calendarMonth").first(),
         notesCreated=pl.len(),
         hitRate=pl.col("noteEverCrh").mean(),
@@ -258,52 +351,84 @@ if __name__ == "__main__":
             for topic in _top_5_topics + ["other"]
         ]
     ).sort("noteAuthorParticipantId", "userMonth")
-    logger.info(f"Aggregated user notes: {len(user_notes):,} rows")
 
-    # Aggregate all users' ratings per month
-    user_ratings = ratings.group_by(["raterParticipantId", "userMonth"]).agg(
+
+# Per-rating code columns for the rating aggregation, computed once before grouping. Each ".filter(mask)" of a
+# per-group expression becomes a column that is null outside the mask, and each combined condition becomes a
+# precomputed boolean, so every output below is a plain sum/mean/n_unique. Polars evaluates those in one vectorized
+# pass over the groups instead of materializing a filtered copy of every group for every expression.
+_RATING_CODES = {
+    "_helpfulFactor":             pl.when(_rated_helpful)    .then(pl.col("noteFinalFactor")),
+    "_notHelpfulFactor":          pl.when(_rated_not_helpful).then(pl.col("noteFinalFactor")),
+    "_helpfulIntercept":          pl.when(_rated_helpful)    .then(pl.col("noteFinalIntercept")),
+    "_notHelpfulIntercept":       pl.when(_rated_not_helpful).then(pl.col("noteFinalIntercept")),
+    "_correctHelpful":            pl.when(_rated_helpful)    .then(_ever_crh),
+    "_correctNotHelpful":         pl.when(_rated_not_helpful).then(_never_crh),
+    "_posFactorHelpful":          _pos_factor & _rated_helpful,
+    "_posFactorNotHelpful":       _pos_factor & _rated_not_helpful,
+    "_negFactorHelpful":          _neg_factor & _rated_helpful,
+    "_negFactorNotHelpful":       _neg_factor & _rated_not_helpful,
+    "_correctPosFactorHelpful":   pl.when(_pos_factor & _rated_helpful)    .then(_ever_crh),
+    "_correctPosFactorNotHelpful":pl.when(_pos_factor & _rated_not_helpful).then(_never_crh),
+    "_correctNegFactorHelpful":   pl.when(_neg_factor & _rated_helpful)    .then(_ever_crh),
+    "_correctNegFactorNotHelpful":pl.when(_neg_factor & _rated_not_helpful).then(_never_crh),
+    "_antiDemNN":                 _posted_by_dem & _note_claims_misinfo     & _rated_helpful,
+    "_proDemNN":                  _posted_by_dem & _note_claims_misinfo     & _rated_not_helpful,
+    "_proDemNNN":                 _posted_by_dem & _note_claims_not_misinfo & _rated_helpful,
+    "_antiDemNNN":                _posted_by_dem & _note_claims_not_misinfo & _rated_not_helpful,
+    "_antiRepNN":                 _posted_by_rep & _note_claims_misinfo     & _rated_helpful,
+    "_proRepNN":                  _posted_by_rep & _note_claims_misinfo     & _rated_not_helpful,
+    "_proRepNNN":                 _posted_by_rep & _note_claims_not_misinfo & _rated_helpful,
+    "_antiRepNNN":                _posted_by_rep & _note_claims_not_misinfo & _rated_not_helpful,
+    **{f"_{topic}Rated": pl.col("condensed_topic") == topic for topic in _top_5_topics + ["other"]},
+}
+
+
+# Aggregate all users' ratings per month, with rating-session columns for each of `session_gaps` (none if empty)
+def _aggregate_user_ratings(ratings: Frame, session_gaps: tuple[float, ...] = SESSION_GAPS_MINUTES) -> Frame:
+    user_ratings = ratings.with_columns(**_RATING_CODES).group_by(["raterParticipantId", "userMonth"]).agg(
         calendarMonth=pl.col("calendarMonth").first(),
         notesRated=pl.len(),
-        avgHelpfulFactor=pl.col("noteFinalFactor").filter(_rated_helpful).mean(),
-        avgNotHelpfulFactor=pl.col("noteFinalFactor").filter(_rated_not_helpful).mean(),
-        avgHelpfulIntercept=pl.col("noteFinalIntercept").filter(_rated_helpful).mean(),
-        avgNotHelpfulIntercept=pl.col("noteFinalIntercept").filter(_rated_not_helpful).mean(),
-        correctHelpfuls=_ever_crh.filter(_rated_helpful).sum(),
-        correctNotHelpfuls=_never_crh.filter(_rated_not_helpful).sum(),
+        avgHelpfulFactor=pl.col("_helpfulFactor").mean(),
+        avgNotHelpfulFactor=pl.col("_notHelpfulFactor").mean(),
+        avgHelpfulIntercept=pl.col("_helpfulIntercept").mean(),
+        avgNotHelpfulIntercept=pl.col("_notHelpfulIntercept").mean(),
+        correctHelpfuls=pl.col("_correctHelpful").sum(),
+        correctNotHelpfuls=pl.col("_correctNotHelpful").sum(),
 
         # Counts by factor sign x helpfulness
-        posFactorRatedHelpful=(_pos_factor & _rated_helpful).sum(),
-        posFactorRatedNotHelpful=(_pos_factor & _rated_not_helpful).sum(),
-        negFactorRatedHelpful=(_neg_factor & _rated_helpful).sum(),
-        negFactorRatedNotHelpful=(_neg_factor & _rated_not_helpful).sum(),
+        posFactorRatedHelpful=pl.col("_posFactorHelpful").sum(),
+        posFactorRatedNotHelpful=pl.col("_posFactorNotHelpful").sum(),
+        negFactorRatedHelpful=pl.col("_negFactorHelpful").sum(),
+        negFactorRatedNotHelpful=pl.col("_negFactorNotHelpful").sum(),
 
         # % correct among +/- factor notes rated helpful/not helpful
-        pctCorrectPosFactorHelpful=_ever_crh.filter(_pos_factor & _rated_helpful).mean(),
-        pctCorrectPosFactorNotHelpful=_never_crh.filter(_pos_factor & _rated_not_helpful).mean(),
-        pctCorrectNegFactorHelpful=_ever_crh.filter(_neg_factor & _rated_helpful).mean(),
-        pctCorrectNegFactorNotHelpful=_never_crh.filter(_neg_factor & _rated_not_helpful).mean(),
+        pctCorrectPosFactorHelpful=pl.col("_correctPosFactorHelpful").mean(),
+        pctCorrectPosFactorNotHelpful=pl.col("_correctPosFactorNotHelpful").mean(),
+        pctCorrectNegFactorHelpful=pl.col("_correctNegFactorHelpful").mean(),
+        pctCorrectNegFactorNotHelpful=pl.col("_correctNegFactorNotHelpful").mean(),
 
         # % correct among helpful/not-helpful ratings overall
-        pctHelpfulRatingsCorrect=_ever_crh.filter(_rated_helpful).mean(),
-        pctNotHelpfulRatingsCorrect=_never_crh.filter(_rated_not_helpful).mean(),
+        pctHelpfulRatingsCorrect=pl.col("_correctHelpful").mean(),
+        pctNotHelpfulRatingsCorrect=pl.col("_correctNotHelpful").mean(),
 
         uniqueDaysRated=pl.col("ratingDate").n_unique(),
         avgPostsRatedPerDay=pl.len() / pl.col("ratingDate").n_unique(),
-        uniqueTopicsRated=pl.col("topic").filter(pl.col("topic").is_not_null()).n_unique(),
+        # n_unique counts null as a value of its own, the original excluded it
+        uniqueTopicsRated=(pl.col("topic").n_unique() - pl.col("topic").is_null().any()).cast(pl.UInt32),
 
         # Classifications from "Hyperactive Minority Alter the Stability of Community Notes" by Nudo et al.
-        antiDemNNRatings    =(_posted_by_dem & _note_claims_misinfo     & _rated_helpful).sum(),
-        proDemNNRatings     =(_posted_by_dem & _note_claims_misinfo     & _rated_not_helpful).sum(),
-        proDemNNNRatings    =(_posted_by_dem & _note_claims_not_misinfo & _rated_helpful).sum(),
-        antiDemNNNRatings   =(_posted_by_dem & _note_claims_not_misinfo & _rated_not_helpful).sum(),
-        antiRepNNRatings    =(_posted_by_rep & _note_claims_misinfo     & _rated_helpful).sum(),
-        proRepNNRatings     =(_posted_by_rep & _note_claims_misinfo     & _rated_not_helpful).sum(),
-        proRepNNNRatings    =(_posted_by_rep & _note_claims_not_misinfo & _rated_helpful).sum(),
-        antiRepNNNRatings   =(_posted_by_rep & _note_claims_not_misinfo & _rated_not_helpful).sum(),
+        antiDemNNRatings    =pl.col("_antiDemNN") .sum(),
+        proDemNNRatings     =pl.col("_proDemNN")  .sum(),
+        proDemNNNRatings    =pl.col("_proDemNNN") .sum(),
+        antiDemNNNRatings   =pl.col("_antiDemNNN").sum(),
+        antiRepNNRatings    =pl.col("_antiRepNN") .sum(),
+        proRepNNRatings     =pl.col("_proRepNN")  .sum(),
+        proRepNNNRatings    =pl.col("_proRepNNN") .sum(),
+        antiRepNNNRatings   =pl.col("_antiRepNNN").sum(),
         *[
-            pl.col("condensed_topic")
-            .filter(pl.col("condensed_topic") == topic)
-            .count()
+            pl.col(f"_{topic}Rated")
+            .sum()
             .alias(f"{topic}RatedCount")
             for topic in _top_5_topics + ["other"]
         ],
@@ -315,10 +440,17 @@ if __name__ == "__main__":
         antiDemRatings=pl.col("antiDemNNRatings") + pl.col("antiDemNNNRatings"),
         proRepRatings=pl.col("proRepNNRatings") + pl.col("proRepNNNRatings"),
         antiRepRatings=pl.col("antiRepNNRatings") + pl.col("antiRepNNNRatings"),
-    ).sort("raterParticipantId", "userMonth")
-    logger.info(f"Aggregated user ratings: {len(user_ratings):,} rows")
+    )
+    # Sessions need every rating sorted by rater and time, so they are only computed when asked for
+    if session_gaps:
+        sessions = monthly_session_aggregates(ratings, session_gaps)
+        user_ratings = user_ratings.join(sessions, on=["raterParticipantId", "userMonth"], how="left", validate="1:1")
+    return user_ratings.sort("raterParticipantId", "userMonth")
 
-    user_requests = requests.group_by(["requesterParticipantId", "userMonth"]).agg(
+
+# Aggregate all users' requests per month
+def _aggregate_user_requests(requests: Frame) -> Frame:
+    return requests.group_by(["requesterParticipantId", "userMonth"]).agg(
         calendarMonth=pl.col("calendarMonth").first(),
         requestsMade=pl.len(),
         numRequestsResultingInCrh   = pl.col("requestResultedInCrh") .sum(),
@@ -326,30 +458,470 @@ if __name__ == "__main__":
         pctRequestResultedInNote    = pl.col("requestResultedInNote").mean(),
         pctRequestResultedInCrh     = pl.col("requestResultedInCrh") .mean(),
     ).sort("requesterParticipantId", "userMonth")
-    logger.info(f"Aggregated user requests: {len(user_requests):,} rows")
 
-    # TODO: Number of ratings sessions + Average number of posts rated per session
 
-    # Write
-    user_notes.write_parquet("data/user_note_traj.parquet")
-    user_ratings.write_parquet("data/user_rating_traj.parquet")
-    user_requests.write_parquet("data/user_request_traj.parquet")
+# First millisecond (UTC) of the calendar month containing `millis`
+def _month_start_millis(millis: int) -> int:
+    dt = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+    return int(datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+# Returns the stored watermark and first-action table, or (None, None) before the first incremental run
+def _load_state() -> tuple[int | None, pl.DataFrame | None]:
+    if not os.path.exists(f"{_STATE_DIR}/watermark.json"):
+        return None, None
+    with open(f"{_STATE_DIR}/watermark.json") as f:
+        watermark_millis = json.load(f)["watermarkMillis"]
+    return watermark_millis, pl.read_parquet(f"{_STATE_DIR}/first_action.parquet")
+
+
+def _save_state(first_action: pl.DataFrame, watermark_millis: int) -> None:
+    os.makedirs(_STATE_DIR, exist_ok=True)
+    first_action.write_parquet(f"{_STATE_DIR}/first_action.parquet")
+    with open(f"{_STATE_DIR}/watermark.json", "w") as f:
+        json.dump({"watermarkMillis": watermark_millis, "updatedAt": datetime.now(timezone.utc).isoformat()}, f)
+    logger.info(f"Saved incremental state for {len(first_action):,} users, watermark {watermark_millis}")
+
+
+# Keep the already-written user-months before `open_month` and replace everything from it onwards
+def _merge_with_existing(traj: Frame, path: str, open_month: str) -> Frame:
+    existing = _read_like(traj, pl.scan_parquet(path).filter(pl.col("calendarMonth") < open_month))
+    columns = existing.collect_schema().names()
+    return pl.concat([existing, traj.select(columns)]).sort(_TRAJ_ID_COLUMNS[path], "userMonth")
+
+
+# Build (or extend the persisted) participant, note and tweet lookups and swap every ID column for its key
+def _intern_ids(
+    notes: Frame, ratings: Frame, requests: Frame, prior_first_action: Frame | None,
+) -> tuple[Frame, Frame, Frame, Frame | None, dict[str, pl.DataFrame]]:
+    id_columns = {
+        "participant": [(notes, "noteAuthorParticipantId"), (ratings, "raterParticipantId"), (requests, "requesterParticipantId")]
+                       + ([(prior_first_action, "participantId")] if prior_first_action is not None else []),
+        "note":        [(notes, "noteId"), (ratings, "noteId")],
+        "tweet":       [(notes, "tweetId"), (requests, "tweetId")],
+    }
+    lookups = {}
+    for name, columns in id_columns.items():
+        ids = [frame.select(pl.col(column).alias("id")).unique() for frame, column in columns]
+        ids = pl.concat([frame.collect(engine="streaming") if isinstance(frame, pl.LazyFrame) else frame for frame in ids])
+        lookups[name] = extend_lookup(ids["id"], load_lookup(name))
+        save_lookup(name, lookups[name])
+    logger.info(
+        f"Interned {len(lookups['participant']):,} participants, {len(lookups['note']):,} notes and {len(lookups['tweet']):,} tweets"
+    )
+
+    notes    = encode(encode(encode(notes, "noteAuthorParticipantId", lookups["participant"]), "noteId", lookups["note"]), "tweetId", lookups["tweet"])
+    ratings  = encode(encode(ratings, "raterParticipantId", lookups["participant"]), "noteId", lookups["note"])
+    requests = encode(encode(requests, "requesterParticipantId", lookups["participant"]), "tweetId", lookups["tweet"])
+    if prior_first_action is not None:
+        prior_first_action = encode(prior_first_action, "participantId", lookups["participant"])
+    return notes, ratings, requests, prior_first_action, lookups
+
+
+# Out-of-core rating aggregation. Ratings are hash-partitioned by rater into spill buckets on local disk in one
+# streaming pass, so every rater-month lands in exactly one bucket. Each bucket then goes through the same rating-side
+# enrichment and aggregation as the in-memory build, against the note-level tables (small next to ratings), and the
+# per-bucket results are concatenated. Peak memory is one bucket plus the note-level tables, per worker.
+_SPILL_TABLES = ("notes", "requests", "scores", "note_ever_crh", "topics", "first_action", "party_cols", "enriched_notes")
+
+
+def _spill_ratings(ratings: pl.LazyFrame, spill_dir: str, buckets: int) -> list[str]:
+    ratings.sink_parquet(
+        pl.PartitionBy(f"{spill_dir}/ratings", key={"_bucket": (pl.col("raterParticipantId").hash(0) % buckets).cast(pl.UInt32)}, include_key=False),
+        mkdir=True,
+        engine="streaming",
+    )
+    bucket_dirs = sorted(entry.path for entry in os.scandir(f"{spill_dir}/ratings") if entry.is_dir())
+    logger.info(f"Spilled ratings into {len(bucket_dirs)} buckets under {spill_dir}")
+    return bucket_dirs
+
+
+# Runs in worker processes, so every input comes from disk. The notes and requests tables are empty frames: the
+# enrichment functions extend notes, ratings (and requests) together, and only the rating side is wanted here.
+def _aggregate_rating_bucket(bucket_dir: str, tables_dir: str, session_gaps: tuple[float, ...]) -> pl.DataFrame:
+    tables = {name: pl.read_parquet(f"{tables_dir}/{name}.parquet") for name in _SPILL_TABLES}
+    no_notes, no_requests = tables["notes"], tables["requests"]
+
+    ratings = pl.read_parquet(f"{bucket_dir}/*.parquet")
+    _, ratings = _enrich_with_scores(no_notes, ratings, tables["scores"])
+    _, ratings, _ = _enrich_with_crh(no_notes, ratings, no_requests, tables["note_ever_crh"])
+    _, ratings = _enrich_with_topics(no_notes, ratings, tables["topics"])
+    _, ratings, _ = _enrich_with_first_action(no_notes, ratings, no_requests, tables["first_action"])
+    ratings = _enrich_with_user_and_calendar_month(ratings)
+    _, ratings = _enrich_with_partisanship(no_notes, ratings, tables["party_cols"])
+    ratings = _enrich_ratings_with_note_data(ratings, tables["enriched_notes"])
+    return _aggregate_user_ratings(ratings, session_gaps)
+
+
+def _aggregate_spilled_ratings(
+    bucket_dirs: list[str], spill_dir: str, workers: int, session_gaps: tuple[float, ...], **tables: pl.DataFrame,
+) -> pl.DataFrame:
+    tables_dir = f"{spill_dir}/tables"
+    os.makedirs(tables_dir, exist_ok=True)
+    for name in _SPILL_TABLES:
+        table = tables[name].clear() if name in ("notes", "requests") else tables[name]
+        table.write_parquet(f"{tables_dir}/{name}.parquet")
+
+    if workers > 1:
+        # Spawned rather than forked: forking a process that has already started Polars' thread pool can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            parts = list(pool.map(_aggregate_rating_bucket, bucket_dirs, [tables_dir] * len(bucket_dirs), [session_gaps] * len(bucket_dirs)))
+    else:
+        parts = [_aggregate_rating_bucket(bucket_dir, tables_dir, session_gaps) for bucket_dir in bucket_dirs]
+    shutil.rmtree(spill_dir)
+    return pl.concat(parts).sort("raterParticipantId", "userMonth")
+
+
+# The pipeline as a stage DAG. Loading, interning, reference tables, first-action minima and the three aggregations
+# are independent of each other and run concurrently; the enrichment joins stay a chain, since each step extends the
+# frames produced by the previous one.
+def _trajectory_stages(args: argparse.Namespace, in_window: pl.Expr) -> list[Stage]:
+    read_parquet = pl.scan_parquet if args.lazy else pl.read_parquet
+    collect = (lambda frame: frame) if args.lazy else (lambda frame: frame.collect())
+    cache = not args.no_cache
+    # When spilling, ratings stay a lazy scan that is streamed into the buckets; the enrichment chain only sees an
+    # empty ratings frame, and the rating aggregation runs bucket by bucket instead
+    spill = args.spill_buckets is not None
+    session_gaps = tuple(args.session_gaps)
+
+    def load_ratings():
+        ratings = pl.scan_parquet(_RATINGS_PATH).filter(in_window)
+        ratings = ratings if spill else collect(ratings)
+        return ratings.with_columns(ratingDate=pl.from_epoch(pl.col("createdAtMillis"), time_unit="ms").dt.date())
+
+    def load_requests():
+        requests = collect(pl.scan_parquet(_REQUESTS_PATH).filter(in_window).rename({"userId": "requesterParticipantId"})) # Using the user-level requests, not post-level requests!
+        return requests.with_columns(requestDate=pl.from_epoch(pl.col("createdAtMillis"), time_unit="ms").dt.date())
+
+    def intern_ids(notes, ratings, requests, prior_first_action):
+        if not args.intern_ids:
+            return notes, ratings, requests, prior_first_action, {}
+        return _intern_ids(notes, ratings, requests, prior_first_action)
+
+    def reference(name, inputs, params, table, note_id_column):
+        return lambda notes, lookups: _reference(notes, name, inputs, params, table, note_id_column, lookups.get("note"), cache)
+
+    def with_months(frame):
+        return _enrich_with_user_and_calendar_month(frame)
+
+    def first_note_rated(ratings):
+        first = _first_action_of(ratings, "raterParticipantId")
+        return first.collect(engine="streaming") if spill else first
+
+    chain_ratings = "spill_ratings_schema" if spill else "ratings"
+    stages = [
+        # Notes are always loaded in full since ratings and requests of any age are enriched with note-level data
+        Stage("load_notes",    lambda: read_parquet(_NOTES_PATH), outputs=("raw_notes",)),
+        Stage("load_ratings",  load_ratings,  outputs=("raw_ratings",)),
+        Stage("load_requests", load_requests, outputs=("raw_requests",)),
+        Stage(
+            "intern_ids", intern_ids,
+            inputs=("raw_notes", "raw_ratings", "raw_requests", "raw_prior_first_action"),
+            outputs=("notes", "ratings", "requests", "prior_first_action", "lookups"),
+        ),
+
+        Stage("scores_table",       reference("scores", [_SCORES_PATH], {"models": _I_AND_F_COLUMNS}, _scores_table, "noteId"),
+              inputs=("notes", "lookups"), outputs=("scores",)),
+        Stage("note_ever_crh_table", reference("note_ever_crh", [_statuses_input()], {"cutoff": _CRH_CUTOFF}, _note_ever_crh_table, "note_id"),
+              inputs=("notes", "lookups"), outputs=("note_ever_crh",)),
+        Stage("topics_table",       reference("topics", [_TOPICS_PATH], {"topTopics": _top_5_topics}, _topics_table, "noteId"),
+              inputs=("notes", "lookups"), outputs=("topics",)),
+        Stage("partisanship_table", reference("partisanship", [_PARTISANSHIP_PATH], {}, _partisanship_table, "note_id"),
+              inputs=("notes", "lookups"), outputs=("party_cols",)),
+
+        Stage("first_note_written",   lambda notes:    _first_action_of(notes,    "noteAuthorParticipantId"), inputs=("notes",),    outputs=("first_note_written",)),
+        Stage("first_note_rated",     first_note_rated,                                                       inputs=("ratings",),  outputs=("first_note_rated",)),
+        Stage("first_note_requested", lambda requests: _first_action_of(requests, "requesterParticipantId"),  inputs=("requests",), outputs=("first_note_requested",)),
+        Stage(
+            "first_action", _combine_first_actions,
+            inputs=("first_note_written", "first_note_rated", "first_note_requested", "prior_first_action"),
+            outputs=("first_action",),
+        ),
+
+        Stage("enrich_with_scores", _enrich_with_scores, inputs=("notes", chain_ratings, "scores"), outputs=("notes_1", "ratings_1")),
+        Stage(
+            "enrich_with_crh", _enrich_with_crh,
+            inputs=("notes_1", "ratings_1", "requests", "note_ever_crh"), outputs=("notes_2", "ratings_2", "requests_2"),
+        ),
+        Stage("enrich_with_topics", _enrich_with_topics, inputs=("notes_2", "ratings_2", "topics"), outputs=("notes_3", "ratings_3")),
+        Stage(
+            "enrich_with_first_action", _enrich_with_first_action,
+            inputs=("notes_3", "ratings_3", "requests_2", "first_action"), outputs=("notes_4", "ratings_4", "requests_4"),
+        ),
+        Stage("notes_months",    with_months, inputs=("notes_4",),    outputs=("notes_5",)),
+        Stage("ratings_months",  with_months, inputs=("ratings_4",),  outputs=("ratings_5",)),
+        Stage("requests_months", with_months, inputs=("requests_4",), outputs=("enriched_requests",)),
+        Stage(
+            "enrich_with_partisanship", _enrich_with_partisanship,
+            inputs=("notes_5", "ratings_5", "party_cols"), outputs=("enriched_notes", "ratings_6"),
+        ),
+        Stage("enrich_ratings_with_note_data", _enrich_ratings_with_note_data, inputs=("ratings_6", "enriched_notes"), outputs=("enriched_ratings",)),
+        Stage("enrich_requests_with_outcomes", _enrich_requests_with_outcomes, inputs=("enriched_requests", "enriched_notes"), outputs=("outcome_requests",)),
+
+        Stage("aggregate_user_notes",    lambda notes: _aggregate_user_notes(notes.filter(in_window)), inputs=("enriched_notes",),   outputs=("user_notes",)),
+        Stage("aggregate_user_requests", _aggregate_user_requests, inputs=("outcome_requests",), outputs=("user_requests",)),
+    ]
+    if not spill:
+        return stages + [
+            Stage("aggregate_user_ratings", lambda ratings: _aggregate_user_ratings(ratings, session_gaps), inputs=("enriched_ratings",), outputs=("user_ratings",)),
+        ]
+
+    os.makedirs(args.spill_dir, exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix="ratings-", dir=args.spill_dir)
+    return stages + [
+        Stage("spill_ratings_schema", lambda ratings: ratings.clear().collect(), inputs=("ratings",), outputs=("spill_ratings_schema",)),
+        Stage("spill_ratings", lambda ratings: _spill_ratings(ratings, spill_dir, args.spill_buckets), inputs=("ratings",), outputs=("rating_buckets",)),
+        Stage(
+            "aggregate_user_ratings",
+            lambda bucket_dirs, *tables: _aggregate_spilled_ratings(
+                bucket_dirs, spill_dir, args.spill_workers, session_gaps, **dict(zip(_SPILL_TABLES, tables)),
+            ),
+            inputs=("rating_buckets", *_SPILL_TABLES),
+            outputs=("user_ratings",),
+        ),
+    ]
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build per-user monthly trajectories from Community Notes data.")
+    parser.add_argument(
+        "--lazy", action="store_true",
+        help="Build the whole pipeline as one LazyFrame plan and stream it into the trajectory files",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help=f"Only aggregate ratings and requests from the last run's open month onwards, using the state in {_STATE_DIR}. "
+        "Notes are still read in full and the full trajectory files rewritten; --partition-by calendarMonth directories "
+        "only have the open month onwards rewritten",
+    )
+    parser.add_argument(
+        "--partition-by", nargs="+", choices=PARTITION_KEYS, default=[],
+        help="Also write each trajectory as a hive-partitioned directory (e.g. data/user_rating_traj/) keyed by these columns",
+    )
+    parser.add_argument(
+        "--buckets", type=int, default=32,
+        help="Number of participant hash buckets when partitioning by participantBucket",
+    )
+    parser.add_argument(
+        "--intern-ids", action="store_true",
+        help="Run all joins and group-bys on dense integer keys instead of string IDs (lookups persisted in data/id_lookup)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Rebuild the derived reference tables (scores, CRH, topics, partisanship) instead of reusing data/cache",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Maximum number of pipeline stages to run at once (defaults to the number of CPUs)",
+    )
+    parser.add_argument(
+        "--spill-buckets", type=int, default=None,
+        help="Aggregate ratings out of core: hash-partition them by rater into this many buckets on disk and process one bucket at a time",
+    )
+    parser.add_argument(
+        "--spill-workers", type=int, default=1,
+        help="Worker processes aggregating spilled rating buckets in parallel (each holds one bucket in memory)",
+    )
+    parser.add_argument(
+        "--spill-dir", default="data/spill",
+        help="Local directory for spilled rating buckets, removed once they are aggregated",
+    )
+    parser.add_argument(
+        "--sample-fraction", type=float, default=None,
+        help="Write the sample files from a deterministic hash sample of this fraction of users, instead of 20,000 randomly drawn users",
+    )
+    parser.add_argument(
+        "--sample-salt", default="",
+        help="Salt for --sample-fraction; each salt gives an independent sample",
+    )
+    parser.add_argument(
+        "--samples", type=int, default=0,
+        help="Also write this many user samples (each of --sample-fraction, default 20,000 users) with one pass over each trajectory",
+    )
+    parser.add_argument(
+        "--bootstrap", action="store_true",
+        help="Draw --samples as Poisson bootstrap replicates (with a weight column) instead of disjoint splits",
+    )
+    parser.add_argument(
+        "--samples-dir", default="data/samples",
+        help="Where --samples are written, one sample_NNN directory per sample",
+    )
+    parser.add_argument(
+        "--panel", action="store_true",
+        help=f"Also write the combined participant-month panel, with gap months filled, to {_PANEL_DIR} "
+             "(partitioned by --partition-by, calendarMonth by default)",
+    )
+    parser.add_argument(
+        "--tensor", choices=LAYOUTS, default=None,
+        help="Also write notesCreated, hits, notesRated and requestsMade as memory-mappable participant x userMonth arrays",
+    )
+    parser.add_argument(
+        "--tensor-dir", default="data/activity_tensor",
+        help="Where the --tensor arrays are written",
+    )
+    parser.add_argument(
+        "--session-gaps", type=float, nargs="*", default=list(SESSION_GAPS_MINUTES),
+        help="Gap thresholds in minutes for the rating-session columns (numRatingSessions{gap}m, avgPostsRatedPerSession{gap}m); "
+        "give none to leave the columns out and skip sorting all ratings by rater and time",
+    )
+    args = parser.parse_args()
+    if args.spill_buckets is not None and args.lazy:
+        parser.error("--spill-buckets already streams ratings bucket by bucket and cannot be combined with --lazy")
+    if args.sample_fraction is not None and not 0 <= args.sample_fraction <= 1:
+        parser.error(f"--sample-fraction must be between 0 and 1, got {args.sample_fraction}")
+    if args.samples < 0:
+        parser.error(f"--samples must not be negative, got {args.samples}")
+    # Checked here rather than by sample_assignments, which only runs once the trajectories are built. The default
+    # per-sample size of 20,000 users depends on the population, so only an explicit fraction can be checked up front.
+    if args.samples and not args.bootstrap and args.sample_fraction is not None and args.samples * args.sample_fraction > 1:
+        parser.error(
+            f"{args.samples} disjoint --samples of --sample-fraction {args.sample_fraction} do not fit in the population; "
+            "lower either or pass --bootstrap"
+        )
+    return args
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    log_summary_at_exit()
+
+    # Incremental runs re-read actions from the start of the month the previous run ended in ("open month").
+    # Months before it stay as already written, including note-derived fields such as request outcomes and CRH
+    # status as they were known then, so a periodic full rebuild is still needed to refresh them. Rating sessions are
+    # only seen from the open month on: a rater's first session there counts as new even if it continues one from the
+    # month before, so numRatingSessions / avgPostsRatedPerSession of the open month can differ slightly from a full
+    # rebuild until the next one.
+    # What this saves is reading and aggregating old ratings and requests. Notes are still loaded in full (ratings of
+    # any age are enriched with them), and the full trajectory files are rewritten with the kept months read back from
+    # them. Directories partitioned with calendarMonth outermost only have the open month onwards rewritten.
+    watermark_millis, prior_first_action = _load_state() if args.incremental else (None, None)
+    since_millis = _month_start_millis(watermark_millis) if watermark_millis is not None else None
+    open_month = datetime.fromtimestamp(since_millis / 1000, tz=timezone.utc).strftime("%Y-%m") if since_millis is not None else None
+    if open_month is not None:
+        logger.info(f"Incremental run: rebuilding user-months from {open_month} onwards")
+        prior_first_action = prior_first_action.lazy() if args.lazy else prior_first_action
+
+    # Load, enrich and aggregate. In lazy mode nothing is read until the trajectory files are sunk, so only the columns
+    # the aggregations need are ever pulled out of the (very wide, very long) ratings file.
+    in_window = pl.col("createdAtMillis") >= since_millis if since_millis is not None else pl.lit(True)
+    values, timings = run_stages(
+        _trajectory_stages(args, in_window), initial={"raw_prior_first_action": prior_first_action}, max_workers=args.workers,
+    )
+    notes, ratings, requests = values["notes"], values["ratings"], values["requests"]
+    lookups, first_action = values["lookups"], values["first_action"]
+    user_notes, user_ratings, user_requests = values["user_notes"], values["user_ratings"], values["user_requests"]
+    pipeline_seconds = max(t.started + t.wall_seconds for t in timings) - min(t.started for t in timings)
+    logger.info(f"Built trajectory plans in {pipeline_seconds:.2f}s" if args.lazy else f"Built trajectories in {pipeline_seconds:.2f}s")
+
+    trajectories = {_NOTE_TRAJ: user_notes, _RATING_TRAJ: user_ratings, _REQUEST_TRAJ: user_requests}
+    if args.intern_ids:
+        # Restore string IDs only on the aggregated rows, re-sorting since key order is not string order
+        trajectories = {
+            path: decode(traj, _TRAJ_ID_COLUMNS[path], lookups["participant"]).sort(_TRAJ_ID_COLUMNS[path], "userMonth")
+            for path, traj in trajectories.items()
+        }
+        first_action = decode(first_action, "participantId", lookups["participant"])
+    if open_month is not None:
+        trajectories = {path: _merge_with_existing(traj, path, open_month) for path, traj in trajectories.items()}
+
+    # The next watermark is the oldest of the three sources' newest actions, so a lagging dump is re-read next time
+    watermark = pl.concat([
+        # Spilled ratings are still a lazy scan here, so every maximum goes through the notes' mode
+        _read_like(notes, frame.lazy().select(pl.col("createdAtMillis").max())) for frame in (notes, ratings, requests)
+    ]).select(pl.col("createdAtMillis").min())
+
+    # Hash-sampled users are picked by ID alone, so the sample files are just filtered copies written alongside
+    samples = {}
+    if args.sample_fraction is not None:
+        samples = {
+            _SAMPLE_PATHS[path]: traj.filter(in_sample(_TRAJ_ID_COLUMNS[path], args.sample_fraction, args.sample_salt))
+            for path, traj in trajectories.items()
+        }
+
+    # Write. Files are written next to their destination and swapped in, since incremental runs read the old ones.
+    with measure("write_trajectories") as stats:
+        if args.lazy:
+            # One streaming collect over the shared plan: the enrichment joins are evaluated once for all sinks
+            *_, first_action, watermark = pl.collect_all(
+                [
+                    *[traj.sink_parquet(f"{path}.tmp", lazy=True) for path, traj in (trajectories | samples).items()],
+                    first_action,
+                    watermark,
+                ],
+                engine="streaming",
+            )
+        else:
+            for path, traj in (trajectories | samples).items():
+                traj.write_parquet(f"{path}.tmp")
+        for path in trajectories | samples:
+            os.replace(f"{path}.tmp", path)
+        user_notes, user_ratings, user_requests = (pl.read_parquet(path) for path in trajectories) if args.lazy else trajectories.values()
+        stats.record_outputs((user_notes, user_ratings, user_requests))
+    logger.info(f"Aggregated user notes: {len(user_notes):,} rows")
+    logger.info(f"Aggregated user ratings: {len(user_ratings):,} rows")
+    logger.info(f"Aggregated user requests: {len(user_requests):,} rows")
     logger.info("Wrote full trajectory files")
 
-    # Sample 20,000 users
-    all_user_ids = first_action.select("participantId").unique().sort("participantId")
-    hash = md5("".join(all_user_ids["participantId"]).encode("utf-8")).hexdigest()
-    logger.info(f"Hash of all user ids: {hash}") # For reproducibility checks
-    sampled_user_ids = all_user_ids.sample(20_000, seed=465309)
-    sampled_user_notes = user_notes.join(sampled_user_ids, left_on="noteAuthorParticipantId", right_on="participantId", how="inner")
-    sampled_user_notes.write_parquet("data/sample_user_note_traj.parquet")
-    sampled_user_ratings = user_ratings.join(sampled_user_ids, left_on="raterParticipantId", right_on="participantId", how="inner")
-    sampled_user_ratings.write_parquet("data/sample_user_rating_traj.parquet")
-    sampled_user_requests = user_requests.join(sampled_user_ids, left_on="requesterParticipantId", right_on="participantId", how="inner")
-    sampled_user_requests.write_parquet("data/sample_user_request_traj.parquet")
+    if args.partition_by:
+        with measure("write_partitioned", (user_notes, user_ratings, user_requests)):
+            for path, traj in zip(trajectories, (user_notes, user_ratings, user_requests)):
+                write_partitioned(
+                    traj, path.removesuffix(".parquet"), _TRAJ_ID_COLUMNS[path], args.partition_by, args.buckets, months_from=open_month,
+                )
+        logger.info(f"Wrote partitioned trajectory directories by {', '.join(args.partition_by)}")
+
+    if args.panel:
+        with measure("write_panel", (user_notes, user_ratings, user_requests)) as stats:
+            panel = build_panel(user_notes, user_ratings, user_requests)
+            write_partitioned(panel, _PANEL_DIR, "participantId", args.partition_by or ["calendarMonth"], args.buckets)
+            stats.record_outputs(panel)
+        logger.info(f"Wrote participant-month panel: {len(panel):,} rows, {(~panel['activeMonth']).sum():,} of them gap months")
+
+    if args.tensor:
+        with measure("write_activity_tensor", (user_notes, user_ratings, user_requests)):
+            participants = lookups.get("participant")
+            if participants is None:
+                participants = extend_lookup(first_action["participantId"], load_lookup("participant"))
+                save_lookup("participant", participants)
+            write_activity_tensor([user_notes, user_ratings, user_requests], participants, args.tensor_dir, args.tensor)
+        logger.info(f"Wrote {args.tensor} activity tensor for {len(participants):,} participants to {args.tensor_dir}")
+
+    if args.incremental:
+        # An empty window (no new data) keeps the previous watermark
+        _save_state(first_action, watermark.item() if watermark.item() is not None else watermark_millis)
+
+    with measure("sample_users", (user_notes, user_ratings, user_requests)) as stats:
+        all_user_ids = first_action.select("participantId").unique().sort("participantId")
+        logger.info(f"Hash of all user ids: {id_digest(all_user_ids['participantId'])}") # For reproducibility checks
+        if args.sample_fraction is None:
+            # Sample 20,000 users
+            sampled_user_ids = all_user_ids.sample(20_000, seed=465309)["participantId"].implode()
+            sampled = [
+                traj.filter(pl.col(_TRAJ_ID_COLUMNS[path]).is_in(sampled_user_ids))
+                for path, traj in zip(trajectories, (user_notes, user_ratings, user_requests))
+            ]
+            for path, traj in zip(trajectories, sampled):
+                traj.write_parquet(_SAMPLE_PATHS[path])
+        else:
+            sampled = [pl.read_parquet(_SAMPLE_PATHS[path]) for path in trajectories]
+        sampled_user_notes, sampled_user_ratings, sampled_user_requests = sampled
+        stats.record_outputs((sampled_user_notes, sampled_user_ratings, sampled_user_requests))
     logger.info(
-        "Wrote sampled trajectory files. Sampled 20_000 users. "
+        ("Wrote sampled trajectory files. Sampled 20_000 users. " if args.sample_fraction is None else
+         f"Wrote sampled trajectory files. Sampled users with hash fraction {args.sample_fraction} (salt {args.sample_salt!r}). ") +
         f"{len(sampled_user_notes):,} user-months with notes from {len(sampled_user_notes['noteAuthorParticipantId'].unique()):,} unique note authors, and "
         f"{len(sampled_user_ratings):,} user-months with ratings from {len(sampled_user_ratings['raterParticipantId'].unique()):,} unique raters."
         f"{len(sampled_user_requests):,} user-months with requests from {len(sampled_user_requests['requesterParticipantId'].unique()):,} unique requesters."
     )
+
+    if args.samples:
+        # Same per-sample size as the 20,000-user sample unless a fraction is given
+        fraction = args.sample_fraction if args.sample_fraction is not None else 20_000 / len(all_user_ids)
+        with measure("write_samples"):
+            assignments = sample_assignments(all_user_ids["participantId"], args.samples, fraction, args.sample_salt, args.bootstrap)
+            description = {"samples": args.samples, "fraction": fraction, "salt": args.sample_salt, "bootstrap": args.bootstrap}
+            write_samples(_TRAJ_ID_COLUMNS, assignments, args.samples_dir, description)
+        logger.info(
+            f"Wrote {args.samples} {'bootstrap' if args.bootstrap else 'disjoint'} samples of ~{fraction * len(all_user_ids):,.0f} users "
+            f"to {args.samples_dir}"
+        )
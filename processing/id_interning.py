@@ -0,0 +1,59 @@
+import os
+
+import polars as pl
+
+# Dense integer surrogates for the long participant, note and tweet IDs. Joins and group-bys on UInt32 keys hash
+# a fraction of the bytes the string IDs do, so the pipeline swaps each ID column for its key in place (same column
+# name, integer dtype) and only restores the original IDs on the aggregated output.
+#
+# Lookups are append-only: an ID keeps its key across runs and new IDs get the next free keys, so anything
+# persisted by key (e.g. arrays indexed by participant key) stays valid after a refresh.
+
+LOOKUP_DIR = "data/id_lookup"
+KEY_DTYPE = pl.UInt32
+
+
+def load_lookup(name: str) -> pl.DataFrame | None:
+    path = f"{LOOKUP_DIR}/{name}.parquet"
+    return pl.read_parquet(path) if os.path.exists(path) else None
+
+
+def save_lookup(name: str, lookup: pl.DataFrame) -> None:
+    os.makedirs(LOOKUP_DIR, exist_ok=True)
+    lookup.write_parquet(f"{LOOKUP_DIR}/{name}.parquet")
+
+
+# Extend `existing` (columns "id", "key") with every non-null ID in `ids` that it does not know yet
+def extend_lookup(ids: pl.Series, existing: pl.DataFrame | None = None) -> pl.DataFrame:
+    if existing is None:
+        existing = pl.DataFrame(schema={"id": ids.dtype, "key": KEY_DTYPE})
+    new = (
+        ids.drop_nulls().unique().to_frame("id")
+        .join(existing, on="id", how="anti")
+        .sort("id")
+        .with_row_index("key", offset=len(existing))
+        .select("id", pl.col("key").cast(KEY_DTYPE))
+    )
+    return pl.concat([existing, new])
+
+
+# Replace the IDs in `column` with their keys. With how="inner" rows whose ID is unknown are dropped, which is what
+# reference tables want: a note missing from the lookup can never match anything in the pipeline.
+def encode(frame, column: str, lookup: pl.DataFrame, how: str = "left"):
+    lookup = lookup.lazy() if isinstance(frame, pl.LazyFrame) else lookup
+    return (
+        frame
+        .join(lookup.rename({"id": column, "key": "_key"}), on=column, how=how, validate="m:1")
+        .with_columns(pl.col("_key").alias(column))
+        .drop("_key")
+    )
+
+
+def decode(frame, column: str, lookup: pl.DataFrame):
+    lookup = lookup.lazy() if isinstance(frame, pl.LazyFrame) else lookup
+    return (
+        frame
+        .join(lookup.rename({"key": column, "id": "_id"}), on=column, how="left", validate="m:1")
+        .with_columns(pl.col("_id").alias(column))
+        .drop("_id")
+    )
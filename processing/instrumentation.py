@@ -0,0 +1,137 @@
+import atexit
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Iterator
+
+import polars as pl
+from loguru import logger
+
+# Per-stage measurements for the trajectory build: wall time, CPU time, peak RSS, and rows / estimated in-memory size
+# of the frames going in and out. Each finished stage is logged as a structured event (the stats land under
+# record.extra.stageStats in the serialized log), and a summary table of every measured stage is logged at exit.
+#
+# CPU time and RSS are process-wide: Polars does its work on its own thread pool, so per-thread counters would miss
+# almost all of it. When stages overlap, their CPU seconds and peaks include each other's work.
+# Row counts and sizes are only known for materialized frames; for lazy ones they are left empty.
+
+
+@dataclass
+class StageStats:
+    name: str
+    started: float
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss_bytes: int = 0
+    rows_in: int | None = None
+    rows_out: int | None = None
+    bytes_in: int | None = None
+    bytes_out: int | None = None
+
+    def record_inputs(self, values: Any) -> None:
+        self.rows_in, self.bytes_in = _frame_sizes(values)
+
+    def record_outputs(self, values: Any) -> None:
+        self.rows_out, self.bytes_out = _frame_sizes(values)
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs (macOS): fall back to the peak so far, reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Total rows and estimated bytes over the frames in `values`, or (None, None) if any of them is still lazy
+def _frame_sizes(values: Any) -> tuple[int | None, int | None]:
+    values = values if isinstance(values, (tuple, list)) else (values,)
+    frames = [value for value in values if isinstance(value, (pl.DataFrame, pl.LazyFrame))]
+    if not frames or any(isinstance(frame, pl.LazyFrame) for frame in frames):
+        return None, None
+    return sum(len(frame) for frame in frames), sum(frame.estimated_size() for frame in frames)
+
+
+# One background thread raising the running peak of every open stage every `interval` seconds
+class _RssSampler:
+    interval = 0.05
+
+    def __init__(self) -> None:
+        self.peaks: dict[int, int] = {}
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    def open(self) -> int:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            token = max(self.peaks, default=0) + 1
+            self.peaks[token] = current_rss_bytes()
+            return token
+
+    def close(self, token: int) -> int:
+        rss = current_rss_bytes()
+        with self.lock:
+            return max(self.peaks.pop(token), rss)
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            rss = current_rss_bytes()
+            with self.lock:
+                for token, peak in self.peaks.items():
+                    self.peaks[token] = max(peak, rss)
+
+
+_sampler = _RssSampler()
+_recorded: list[StageStats] = []
+_recorded_lock = threading.Lock()
+
+
+@contextmanager
+def measure(name: str, inputs: Any = ()) -> Iterator[StageStats]:
+    stats = StageStats(name, started=time.perf_counter())
+    stats.record_inputs(inputs)
+    cpu_started = time.process_time()
+    token = _sampler.open()
+    try:
+        yield stats
+    finally:
+        stats.peak_rss_bytes = _sampler.close(token)
+        stats.wall_seconds = time.perf_counter() - stats.started
+        stats.cpu_seconds = time.process_time() - cpu_started
+        with _recorded_lock:
+            _recorded.append(stats)
+        logger.bind(event="stage_stats", stageStats=asdict(stats)).info(
+            f"Stage {name} finished in {stats.wall_seconds:.2f}s "
+            f"(CPU {stats.cpu_seconds:.2f}s, peak RSS {stats.peak_rss_bytes / 1024**2:,.0f} MiB)"
+        )
+
+
+def _fmt(value: int | None, scale: int = 1) -> str:
+    return "-" if value is None else f"{value / scale:,.0f}"
+
+
+def summary_table(stats: list[StageStats]) -> str:
+    header = f"{'stage':<32} {'wall s':>8} {'cpu s':>8} {'peak MiB':>9} {'rows in':>13} {'rows out':>13} {'MiB in':>8} {'MiB out':>8}"
+    lines = [header, "-" * len(header)]
+    for s in sorted(stats, key=lambda s: s.started):
+        lines.append(
+            f"{s.name:<32} {s.wall_seconds:>8.2f} {s.cpu_seconds:>8.2f} {_fmt(s.peak_rss_bytes, 1024**2):>9} "
+            f"{_fmt(s.rows_in):>13} {_fmt(s.rows_out):>13} {_fmt(s.bytes_in, 1024**2):>8} {_fmt(s.bytes_out, 1024**2):>8}"
+        )
+    return "\n".join(lines)
+
+
+# Log the summary table of every stage measured in this process when it exits, including after a failure
+def log_summary_at_exit() -> None:
+    def log_summary():
+        with _recorded_lock:
+            if _recorded:
+                logger.info("Stage summary:\n" + summary_table(_recorded))
+    atexit.register(log_summary)
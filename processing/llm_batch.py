@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from hashlib import blake2b
+from typing import Any, Callable, Iterable, Iterator, Protocol
+
+import polars as pl
+from loguru import logger
+from openai import OpenAI
+
+try:
+    from .llm_labeling import LabelingEngine, LabelResult, mock_response
+except ImportError:
+    from llm_labeling import LabelingEngine, LabelResult, mock_response
+
+# Bulk labeling through a batch API: every prompt is rendered up front into JSONL request files, the files are
+# submitted as batches, and the results are streamed back once the batches finish. Batches cost about half as much as
+# the same requests made one at a time, and have their own, much larger rate limits, at the price of waiting (up to
+# 24 hours, usually minutes):
+#
+#   from processing.llm_batch import OpenAIBatchBackend, label_frame_batch
+#   labeled = label_frame_batch(OpenAIBatchBackend(), notes, prompts, "data/llm_batches/notes_partisan", id_column="noteId")
+#
+# The backend is pluggable. OpenAIBatchBackend uploads to the Batch API; FileBatchBackend is a local fake that answers
+# every request with `respond(prompt)` once it has been polled a few times, for tests and dry runs:
+#
+#   python processing/llm_batch.py --prompts 5000 --work-dir /tmp/llm_batch_demo
+#
+# `work_dir` keeps the request files and the submitted batch IDs (_batches.json), so a run that is interrupted while
+# waiting picks up the same batches when started again instead of paying for them twice. The same prompts, model and
+# params have to be passed again; anything else needs a new work_dir. Requests that come back with an error (including
+# those of a batch that expired or was cancelled) can be labeled live instead, by giving label_frame_batch a `fallback`
+# LabelingEngine, or retried by labeling just them into a new work_dir.
+
+ENDPOINT = "/v1/responses"
+# The Batch API takes at most 50,000 requests and 200 MB per file
+_MAX_FILE_REQUESTS = 50_000
+_MAX_FILE_BYTES = 190 * 1024**2
+_FINISHED = ("completed", "failed", "expired", "cancelled")
+
+
+@dataclass
+class BatchStatus:
+    status: str
+    completed: int = 0
+    failed: int = 0
+    total: int = 0
+    # Why the batch as a whole failed, if it did
+    message: str | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED
+
+
+class BatchBackend(Protocol):
+    # Starts a batch over a JSONL request file, returning its ID
+    def submit(self, request_path: str) -> str: ...
+
+    def status(self, batch_id: str) -> BatchStatus: ...
+
+    # The output and error lines of a finished batch, one parsed JSON object per request
+    def results(self, batch_id: str) -> Iterator[dict]: ...
+
+    def cancel(self, batch_id: str) -> None: ...
+
+
+class OpenAIBatchBackend:
+    def __init__(self, client: OpenAI | None = None, completion_window: str = "24h") -> None:
+        self.client = client or OpenAI()
+        self.completion_window = completion_window
+
+    def submit(self, request_path: str) -> str:
+        with open(request_path, "rb") as f:
+            upload = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=upload.id, endpoint=ENDPOINT, completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, batch_id: str) -> BatchStatus:
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        message = "; ".join(error.message or "" for error in batch.errors.data or []) if batch.errors else None
+        return BatchStatus(batch.status, counts.completed if counts else 0, counts.failed if counts else 0, counts.total if counts else 0, message)
+
+    def results(self, batch_id: str) -> Iterator[dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            # Streamed, since output files can run to hundreds of MB
+            with self.client.files.with_streaming_response.content(file_id) as response:
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+
+    def cancel(self, batch_id: str) -> None:
+        self.client.batches.cancel(batch_id)
+
+
+# A stand-in for the Batch API that keeps its batches under `directory`. A batch completes on its `polls`-th status
+# check, answering each request with `respond(prompt)`; requests for which `respond` raises end up in the error file.
+# Its state lives on disk, so a restarted run finds the batches it submitted before.
+class FileBatchBackend:
+    def __init__(
+        self,
+        directory: str,
+        respond: Callable[[str], str] = lambda prompt: "NONE",
+        polls: int = 2,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.respond = respond
+        self.polls = polls
+        self.submitted = 0
+
+    def _state_path(self, batch_id: str) -> str:
+        return f"{self.directory}/{batch_id}/state.json"
+
+    def _load(self, batch_id: str) -> dict:
+        with open(self._state_path(batch_id)) as f:
+            return json.load(f)
+
+    def _save(self, batch_id: str, state: dict) -> None:
+        with open(f"{self._state_path(batch_id)}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self._state_path(batch_id)}.tmp", self._state_path(batch_id))
+
+    def submit(self, request_path: str) -> str:
+        batch_id = f"batch_file_{uuid.uuid4().hex[:16]}"
+        os.makedirs(f"{self.directory}/{batch_id}")
+        shutil.copyfile(request_path, f"{self.directory}/{batch_id}/input.jsonl")
+        with open(request_path) as f:
+            total = sum(1 for _ in f)
+        self._save(batch_id, {"status": "in_progress", "polls": 0, "completed": 0, "failed": 0, "total": total})
+        self.submitted += 1
+        return batch_id
+
+    def status(self, batch_id: str) -> BatchStatus:
+        state = self._load(batch_id)
+        if state["status"] == "in_progress":
+            state["polls"] += 1
+            if state["polls"] >= self.polls:
+                state.update(self._process(batch_id), status="completed")
+            self._save(batch_id, state)
+        return BatchStatus(state["status"], state["completed"], state["failed"], state["total"])
+
+    def _process(self, batch_id: str) -> dict:
+        path = f"{self.directory}/{batch_id}"
+        completed = failed = 0
+        with open(f"{path}/input.jsonl") as requests, open(f"{path}/output.jsonl", "w") as output, open(f"{path}/errors.jsonl", "w") as errors:
+            for number, line in enumerate(requests):
+                request = json.loads(line)
+                body = request["body"]
+                try:
+                    text = self.respond(body["input"])
+                except Exception as error:
+                    failed += 1
+                    response = {"status_code": 500, "request_id": f"req_file_{number}", "body": {"error": {"message": str(error), "type": "server_error"}}}
+                    errors.write(json.dumps({"id": f"batch_req_{number}", "custom_id": request["custom_id"], "response": response, "error": None}) + "\n")
+                    continue
+                completed += 1
+                response = {"status_code": 200, "request_id": f"req_file_{number}", "body": mock_response(body["model"], body["input"], text, number)}
+                output.write(json.dumps({"id": f"batch_req_{number}", "custom_id": request["custom_id"], "response": response, "error": None}) + "\n")
+        return {"completed": completed, "failed": failed}
+
+    def results(self, batch_id: str) -> Iterator[dict]:
+        for name in ("output.jsonl", "errors.jsonl"):
+            path = f"{self.directory}/{batch_id}/{name}"
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        yield json.loads(line)
+
+    def cancel(self, batch_id: str) -> None:
+        state = self._load(batch_id)
+        if state["status"] == "in_progress":
+            self._save(batch_id, {**state, "status": "cancelled"})
+
+
+def batch_request(custom_id: str, prompt: str, model: str, params: dict[str, Any]) -> dict:
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": {"model": model, "input": prompt, **params}}
+
+
+# Writes the requests to requests-NNNNN.jsonl files in `work_dir`, each within the API's size limits. Returns the paths
+# and a digest of everything written, which tells a resumed run whether it was given the same requests.
+def write_request_files(
+    custom_ids: Iterable[str],
+    prompts: Iterable[str],
+    work_dir: str,
+    model: str,
+    params: dict[str, Any],
+    max_requests: int = _MAX_FILE_REQUESTS,
+    max_bytes: int = _MAX_FILE_BYTES,
+) -> tuple[list[str], str]:
+    os.makedirs(work_dir, exist_ok=True)
+    paths, seen, digest = [], set(), blake2b(digest_size=16)
+    f, requests, size = None, 0, 0
+    for custom_id, prompt in zip(custom_ids, prompts, strict=True):
+        if custom_id in seen:
+            raise ValueError(f"Duplicate custom_id {custom_id!r}; every request needs its own")
+        seen.add(custom_id)
+        line = (json.dumps(batch_request(custom_id, prompt, model, params), ensure_ascii=False) + "\n").encode("utf-8")
+        if f is None or requests == max_requests or size + len(line) > max_bytes:
+            if f is not None:
+                f.close()
+            paths.append(f"{work_dir}/requests-{len(paths):05d}.jsonl")
+            f, requests, size = open(paths[-1], "wb"), 0, 0
+        f.write(line)
+        digest.update(line)
+        requests += 1
+        size += len(line)
+    if f is not None:
+        f.close()
+    return paths, digest.hexdigest()
+
+
+def _output_text(body: dict) -> str:
+    return "".join(
+        content.get("text", "")
+        for item in body.get("output") or [] if item.get("type") == "message"
+        for content in item.get("content") or [] if content.get("type") == "output_text"
+    )
+
+
+def _label_result(line: dict) -> LabelResult:
+    response, error = line.get("response"), line.get("error")
+    if response is not None and response.get("status_code") == 200:
+        usage = response["body"].get("usage") or {}
+        return LabelResult(_output_text(response["body"]), usage.get("input_tokens", 0), usage.get("output_tokens", 0), attempts=1)
+    if error is not None:
+        return LabelResult(None, attempts=1, error=f"{error.get('code')}: {error.get('message')}")
+    message = (response["body"].get("error") or {}).get("message")
+    return LabelResult(None, attempts=1, error=f"HTTP {response['status_code']}: {message}")
+
+
+def _request_ids(path: str) -> Iterator[str]:
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)["custom_id"]
+
+
+# Submits one batch per request file (re-using the batches recorded in work_dir/_batches.json) and records their IDs
+def _submit(backend: BatchBackend, paths: list[str], digest: str, work_dir: str) -> list[str]:
+    state_path = f"{work_dir}/_batches.json"
+    state = {"digest": digest, "files": {}}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state["digest"] != digest:
+            raise ValueError(f"{work_dir} holds batches for other requests; use a new work directory")
+        logger.info(f"Re-attaching to {len(state['files']):,} batches submitted earlier from {work_dir}")
+
+    for path in paths:
+        name = os.path.basename(path)
+        if name in state["files"]:
+            continue
+        state["files"][name] = backend.submit(path)
+        logger.info(f"Submitted {name} as batch {state['files'][name]}")
+        with open(f"{state_path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{state_path}.tmp", state_path)
+    return [state["files"][os.path.basename(path)] for path in paths]
+
+
+# Labels every prompt through `backend`, yielding (custom_id, result) pairs batch by batch as the batches finish.
+# Requests a batch did not answer (it failed, expired or was cancelled) come back with an error result.
+def label_batch(
+    backend: BatchBackend,
+    custom_ids: Iterable[str],
+    prompts: Iterable[str],
+    work_dir: str,
+    model: str = "gpt-4.1-mini",
+    poll_seconds: float = 30.0,
+    max_file_requests: int = _MAX_FILE_REQUESTS,
+    **params: Any,
+) -> Iterator[tuple[str, LabelResult]]:
+    paths, digest = write_request_files(custom_ids, prompts, work_dir, model, params, max_file_requests)
+    batch_ids = _submit(backend, paths, digest, work_dir)
+    pending, started = dict(zip(batch_ids, paths)), time.monotonic()
+    while pending:
+        statuses = {batch_id: backend.status(batch_id) for batch_id in pending}
+        for batch_id, status in statuses.items():
+            if not status.finished:
+                continue
+            if status.status != "completed":
+                logger.warning(f"Batch {batch_id} {status.status}" + (f": {status.message}" if status.message else ""))
+            answered = set()
+            for line in backend.results(batch_id):
+                answered.add(line["custom_id"])
+                yield line["custom_id"], _label_result(line)
+            for custom_id in _request_ids(pending[batch_id]):
+                if custom_id not in answered:
+                    yield custom_id, LabelResult(None, error=f"Not answered: batch {batch_id} {status.status}")
+            del pending[batch_id]
+        if pending:
+            logger.info(
+                f"Waiting on {len(pending):,} of {len(batch_ids):,} batches after {time.monotonic() - started:.0f}s: "
+                f"{sum(statuses[b].completed + statuses[b].failed for b in pending):,} of {sum(statuses[b].total for b in pending):,} requests done"
+            )
+            time.sleep(poll_seconds)
+
+
+# label_frame over a batch backend: the rows of `frame` with llm_output, input_tokens, output_tokens, llm_error and
+# from_cache added. `id_column` (unique) names the requests. With a `fallback` engine (which should use the same model
+# and params), requests the batches did not answer are labeled live through it.
+def label_frame_batch(
+    backend: BatchBackend,
+    frame: pl.DataFrame,
+    prompts: pl.Series | list[str],
+    work_dir: str,
+    id_column: str = "post_id",
+    model: str = "gpt-4.1-mini",
+    poll_seconds: float = 30.0,
+    fallback: LabelingEngine | None = None,
+    **params: Any,
+) -> pl.DataFrame:
+    custom_ids, prompts = frame[id_column].cast(pl.String), list(prompts)
+    results = dict(label_batch(backend, custom_ids, prompts, work_dir, model, poll_seconds, **params))
+    results = [results[custom_id] for custom_id in custom_ids]
+    failed = [i for i, result in enumerate(results) if result.error is not None]
+    if fallback is not None and failed:
+        logger.info(f"Labeling {len(failed):,} requests the batches did not answer live")
+        for i, result in zip(failed, asyncio.run(fallback.label([prompts[i] for i in failed]))):
+            results[i] = result
+    return frame.with_columns(
+        llm_output=pl.Series([r.output_text for r in results], dtype=pl.String),
+        input_tokens=pl.Series([r.input_tokens for r in results], dtype=pl.UInt32),
+        output_tokens=pl.Series([r.output_tokens for r in results], dtype=pl.UInt32),
+        llm_error=pl.Series([r.error for r in results], dtype=pl.String),
+        from_cache=pl.Series([r.cached for r in results], dtype=pl.Boolean),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Label prompts through the local fake batch backend.")
+    parser.add_argument("--prompts", type=int, default=1000)
+    parser.add_argument("--work-dir", default="data/llm_batches/demo")
+    parser.add_argument("--max-requests", type=int, default=_MAX_FILE_REQUESTS, help="Requests per request file")
+    parser.add_argument("--polls", type=int, default=2, help="Status checks until a fake batch completes")
+    args = parser.parse_args()
+
+    backend = FileBatchBackend(f"{args.work_dir}/_backend", polls=args.polls)
+    prompts = (f"Label this post #{i}: ..." for i in range(args.prompts))
+    results = dict(label_batch(
+        backend, (f"post-{i}" for i in range(args.prompts)), prompts, args.work_dir, poll_seconds=0.1, max_file_requests=args.max_requests,
+    ))
+    logger.info(
+        f"{sum(r.error is None for r in results.values()):,} of {len(results):,} prompts labeled through "
+        f"{backend.submitted:,} batches, {sum(r.input_tokens + r.output_tokens for r in results.values()):,} tokens"
+    )
@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from hashlib import blake2b
+from typing import Any
+
+from loguru import logger
+
+# On-disk cache of LLM responses, keyed by a hash of (model, prompt, generation params), so re-runs and prompt sweeps
+# only query the model for prompts it has not answered yet:
+#
+#   from processing.llm_cache import ResponseCache
+#   from processing.llm_labeling import LabelingEngine
+#   engine = LabelingEngine(AsyncOpenAI(), cache=ResponseCache("data/llm_cache.sqlite", max_megabytes=500))
+#
+# One SQLite file holds the raw output_text and token usage of every answered prompt. With `max_megabytes`, the least
+# recently used responses are evicted once the stored text outgrows it. Several processes can share the file.
+#
+#   python processing/llm_cache.py data/llm_cache.sqlite                    # statistics
+#   python processing/llm_cache.py data/llm_cache.sqlite --evict-to 200     # shrink to 200 MB
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key           TEXT PRIMARY KEY,
+    model         TEXT NOT NULL,
+    output_text   TEXT NOT NULL,
+    input_tokens  INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    bytes         INTEGER NOT NULL,
+    created_at    REAL NOT NULL,
+    used_at       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+"""
+# Eviction frees down to this fraction of the limit, so it does not run again on the very next insert
+_EVICT_TO = 0.9
+
+
+def cache_key(model: str, prompt: str, params: dict[str, Any]) -> str:
+    payload = json.dumps({"model": model, "prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+    return blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    output_text: str
+    input_tokens: int
+    output_tokens: int
+
+
+@dataclass
+class CacheStats:
+    entries: int
+    megabytes: float
+    hits: int
+    misses: int
+    # Tokens the hits would have cost
+    saved_tokens: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class ResponseCache:
+    def __init__(self, path: str = "data/llm_cache.sqlite", max_megabytes: float | None = None) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = None if max_megabytes is None else int(max_megabytes * 1024**2)
+        # Autocommit, with a write-ahead log so other processes can read and write the file at the same time
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        self.hits = self.misses = self.saved_tokens = 0
+        # Running total, recounted before evicting since other processes may have written meanwhile
+        self.stored_bytes = self._stored_bytes()
+
+    def get(self, key: str) -> CachedResponse | None:
+        row = self.db.execute("SELECT output_text, input_tokens, output_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.db.execute("UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        self.saved_tokens += row[1] + row[2]
+        return CachedResponse(*row)
+
+    def put(self, key: str, model: str, response: CachedResponse) -> None:
+        now, size = time.time(), len(response.output_text.encode("utf-8"))
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, model, response.output_text, response.input_tokens, response.output_tokens, size, now, now),
+        )
+        self.stored_bytes += size
+        if self.max_bytes is not None and self.stored_bytes > self.max_bytes:
+            self.evict(int(self.max_bytes * _EVICT_TO))
+
+    def _stored_bytes(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM responses").fetchone()[0]
+
+    # Drop least recently used responses until the stored text fits in `max_bytes`; returns how many were dropped
+    def evict(self, max_bytes: int) -> int:
+        self.stored_bytes = self._stored_bytes()
+        excess = self.stored_bytes - max_bytes
+        if excess <= 0:
+            return 0
+        # Oldest first, up to and including the response that brings the freed bytes to `excess`
+        evicted = self.db.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(bytes) OVER (ORDER BY used_at, key) - bytes AS freed_before FROM responses)
+                WHERE freed_before < ?
+            )
+            """,
+            (excess,),
+        ).rowcount
+        self.stored_bytes = self._stored_bytes()
+        logger.info(f"Evicted {evicted:,} cached responses from {self.path}")
+        return evicted
+
+    def stats(self) -> CacheStats:
+        entries, stored = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses").fetchone()
+        return CacheStats(entries, stored / 1024**2, self.hits, self.misses, self.saved_tokens)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show statistics of an LLM response cache, or shrink it.")
+    parser.add_argument("path", nargs="?", default="data/llm_cache.sqlite")
+    parser.add_argument("--evict-to", type=float, default=None, help="Evict least recently used responses down to this many MB")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.path)
+    if args.evict_to is not None:
+        cache.evict(int(args.evict_to * 1024**2))
+        cache.db.execute("VACUUM")
+    stats = cache.stats()
+    logger.info(f"{args.path}: {stats.entries:,} responses, {stats.megabytes:,.1f} MB of output text")
+    for model, entries, tokens in cache.db.execute(
+        "SELECT model, COUNT(*), SUM(input_tokens + output_tokens) FROM responses GROUP BY model ORDER BY model"
+    ):
+        logger.info(f"  {model}: {entries:,} responses, {tokens:,} tokens")
+    cache.close()
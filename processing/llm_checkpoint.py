@@ -0,0 +1,180 @@
+import asyncio
+import glob
+import json
+import os
+from datetime import datetime, timezone
+
+import polars as pl
+from loguru import logger
+
+try:
+    from .llm_labeling import LabelingEngine, LabelResult
+except ImportError:
+    from llm_labeling import LabelingEngine, LabelResult
+
+# Resumable labeling runs. Results are appended to `output_dir` in batches as they come in, and after every batch a
+# cursor (_cursor.json) records what has been durably written. A restarted run reads the labeled IDs back, skips them,
+# and carries on, so a crash at row 90,000 costs at most one batch:
+#
+#   from processing.llm_checkpoint import label_with_checkpoints, read_labels
+#   label_with_checkpoints(engine, notes, prompts, "data/labels/notes_partisan", id_column="post_id")
+#   labels = read_labels("data/labels/notes_partisan")
+#
+# Two formats:
+#   - parquet: one part-NNNNNN.parquet per batch, each written to a temporary name, synced and renamed into place
+#   - jsonl:   one labels.jsonl, appended to and synced per batch; the cursor holds its committed length, and anything
+#              past it (a batch torn by the crash) is cut off on resume
+# Prompts that fail are not written, so the next run retries them. A run refuses to resume output written with a
+# different model or params, since the labels would not be comparable.
+
+FORMATS = ("parquet", "jsonl")
+
+
+class CheckpointWriter:
+    def __init__(self, output_dir: str, id_column: str, model: str, params: dict, format: str = "parquet") -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format!r}, expected one of {FORMATS}")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir, self.id_column, self.format = output_dir, id_column, format
+        self.run = {"idColumn": id_column, "model": model, "params": params, "format": format}
+        self.cursor = {**self.run, "parts": 0, "bytes": 0, "rows": 0}
+
+        if os.path.exists(self._cursor_path):
+            with open(self._cursor_path) as f:
+                cursor = json.load(f)
+            recorded = {key: cursor.get(key) for key in self.run}
+            if recorded != self.run:
+                raise ValueError(f"{output_dir} was labeled with {recorded}, not {self.run}; use a new output directory")
+            self.cursor = cursor
+        self._discard_uncommitted()
+
+    @property
+    def _cursor_path(self) -> str:
+        return f"{self.output_dir}/_cursor.json"
+
+    @property
+    def _jsonl_path(self) -> str:
+        return f"{self.output_dir}/labels.jsonl"
+
+    def _part_path(self, part: int) -> str:
+        return f"{self.output_dir}/part-{part:06d}.parquet"
+
+    # Drop whatever a crash left behind after the last cursor update
+    def _discard_uncommitted(self) -> None:
+        if self.format == "parquet":
+            for path in glob.glob(f"{self.output_dir}/part-*.parquet*"):
+                name = os.path.basename(path)
+                if name.endswith(".tmp") or int(name[len("part-"):len("part-") + 6]) >= self.cursor["parts"]:
+                    os.remove(path)
+        elif os.path.exists(self._jsonl_path) and os.path.getsize(self._jsonl_path) > self.cursor["bytes"]:
+            with open(self._jsonl_path, "r+b") as f:
+                f.truncate(self.cursor["bytes"])
+
+    # IDs labeled by earlier runs into this directory
+    def labeled_ids(self) -> pl.Series:
+        if self.cursor["rows"] == 0:
+            return pl.Series(self.id_column, [])
+        return read_labels(self.output_dir)[self.id_column]
+
+    def append(self, batch: pl.DataFrame) -> None:
+        if self.format == "parquet":
+            path = self._part_path(self.cursor["parts"])
+            batch.write_parquet(f"{path}.tmp")
+            _fsync(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            self.cursor["parts"] += 1
+        else:
+            with open(self._jsonl_path, "ab") as f:
+                batch.write_ndjson(f)
+                f.flush()
+                os.fsync(f.fileno())
+                self.cursor["bytes"] = f.tell()
+        self.cursor["rows"] += len(batch)
+        self.cursor["updatedAt"] = datetime.now(timezone.utc).isoformat()
+        # Replaced atomically, so a crash leaves either the old cursor or the new one
+        with open(f"{self._cursor_path}.tmp", "w") as f:
+            json.dump(self.cursor, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self._cursor_path}.tmp", self._cursor_path)
+
+
+def _fsync(path: str) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+# Everything labeled into `output_dir` so far, one row per ID
+def read_labels(output_dir: str) -> pl.DataFrame:
+    with open(f"{output_dir}/_cursor.json") as f:
+        cursor = json.load(f)
+    if cursor["format"] == "parquet":
+        parts = [f"{output_dir}/part-{part:06d}.parquet" for part in range(cursor["parts"])]
+        return pl.read_parquet(parts) if parts else pl.DataFrame()
+    with open(f"{output_dir}/labels.jsonl", "rb") as f:
+        labels = pl.read_ndjson(f.read(cursor["bytes"])) if cursor["bytes"] else pl.DataFrame()
+    # JSON has no unsigned types, so match the Parquet schema
+    return labels.with_columns(pl.col("input_tokens", "output_tokens").cast(pl.UInt32)) if len(labels) else labels
+
+
+def _batch_frame(id_column: str, rows: list[tuple[object, LabelResult]], id_dtype: pl.DataType) -> pl.DataFrame:
+    return pl.DataFrame({
+        id_column: pl.Series([id_ for id_, _ in rows], dtype=id_dtype),
+        "llm_output": pl.Series([r.output_text for _, r in rows], dtype=pl.String),
+        "input_tokens": pl.Series([r.input_tokens for _, r in rows], dtype=pl.UInt32),
+        "output_tokens": pl.Series([r.output_tokens for _, r in rows], dtype=pl.UInt32),
+        "from_cache": pl.Series([r.cached for _, r in rows], dtype=pl.Boolean),
+    })
+
+
+# Label the rows of `frame` not yet in `output_dir`, appending every `batch_size` finished results. `prompts` holds one
+# prompt per row of `frame`. Returns the number of rows labeled by this run.
+async def run_with_checkpoints(
+    engine: LabelingEngine,
+    frame: pl.DataFrame,
+    prompts: pl.Series | list[str],
+    output_dir: str,
+    id_column: str = "post_id",
+    batch_size: int = 500,
+    format: str = "parquet",
+) -> int:
+    writer = CheckpointWriter(output_dir, id_column, engine.model, engine.params, format)
+    if frame[id_column].is_duplicated().any():
+        raise ValueError(f"{id_column} must be unique to resume by it")
+    todo = frame.select(id_column).with_columns(_prompt=pl.Series(list(prompts), dtype=pl.String))
+    labeled = writer.labeled_ids()
+    if len(labeled):
+        todo = todo.filter(~pl.col(id_column).is_in(labeled.cast(frame.schema[id_column]).implode()))
+        logger.info(f"Resuming {output_dir}: {len(labeled):,} rows already labeled, {len(todo):,} to go")
+
+    ids, pending, failed = todo[id_column], [], 0
+
+    def on_result(index: int, result: LabelResult) -> None:
+        nonlocal failed
+        if result.error is not None:
+            failed += 1
+            logger.warning(f"Not labeled, retried next run: {id_column}={ids[index]}: {result.error}")
+            return
+        pending.append((ids[index], result))
+        if len(pending) >= batch_size:
+            writer.append(_batch_frame(id_column, pending, ids.dtype))
+            pending.clear()
+
+    await engine.label_each(todo["_prompt"], on_result)
+    if pending:
+        writer.append(_batch_frame(id_column, pending, ids.dtype))
+    logger.info(f"Labeled {len(todo) - failed:,} rows into {output_dir}" + (f", {failed:,} failed" if failed else ""))
+    return len(todo) - failed
+
+
+# Sync entry point for scripts
+def label_with_checkpoints(
+    engine: LabelingEngine,
+    frame: pl.DataFrame,
+    prompts: pl.Series | list[str],
+    output_dir: str,
+    id_column: str = "post_id",
+    batch_size: int = 500,
+    format: str = "parquet",
+) -> int:
+    return asyncio.run(run_with_checkpoints(engine, frame, prompts, output_dir, id_column, batch_size, format))
@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+import polars as pl
+from loguru import logger
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+
+# Importable both as processing.llm_labeling (from the repo root) and as a script or sibling module of processing/
+try:
+    from .llm_cache import CachedResponse, ResponseCache, cache_key
+except ImportError:
+    from llm_cache import CachedResponse, ResponseCache, cache_key
+
+# Concurrent LLM labeling. Instead of one blocking responses.create per row, up to `max_concurrency` requests are in
+# flight at once, paced by two token buckets (requests per minute and tokens per minute, matching the API's limits).
+# A 429 pauses every worker for the server's Retry-After (or an exponential, jittered backoff) and halves the request
+# rate, which then creeps back up with each success, so a run settles just under the account's real limit.
+#
+# From a script:
+#   from processing.llm_labeling import LabelingEngine, label_frame
+#   engine = LabelingEngine(AsyncOpenAI(), model="gpt-4.1-mini", requests_per_minute=500, tokens_per_minute=200_000)
+#   labeled = label_frame(engine, df, df["tweet"].map_elements(PROMPT.format, return_dtype=pl.String))
+# In a notebook, where an event loop is already running, await engine.label(prompts) instead.
+# With cache=ResponseCache(...), prompts already answered for the same model and params are served from disk.
+#
+# MockResponsesServer is a local stand-in for the Responses API with its own rate limit, for trying settings without
+# spending anything:
+#   python processing/llm_labeling.py --prompts 2000 --mock-requests-per-minute 1200 --max-concurrency 64
+
+_CHARS_PER_TOKEN = 4                # Rough prompt size estimate; corrected with the reported usage afterwards
+_DEFAULT_OUTPUT_TOKENS = 256        # Assumed output size when max_output_tokens is not set
+_MAX_BACKOFF_SECONDS = 60.0
+
+
+@dataclass
+class LabelResult:
+    output_text: str | None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    attempts: int = 0
+    error: str | None = None
+    cached: bool = False
+
+
+# Allows `per_minute` units per minute, in bursts of up to a minute's worth. `consume` can take the level below zero
+# to settle a reservation that turned out too small, which later acquisitions then wait out.
+class TokenBucket:
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        amount = min(amount, self.per_minute)
+        # Held while waiting, so requests are served in arrival order and a large one is not starved by small ones
+        async with self.lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) * 60 / self.per_minute)
+                self._refill()
+            self.level -= amount
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+
+@dataclass
+class LabelingStats:
+    requests: int = 0
+    cached: int = 0
+    rate_limited: int = 0
+    retried_errors: int = 0
+    failed: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+
+class LabelingEngine:
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        model: str = "gpt-4.1-mini",
+        max_concurrency: int = 16,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 200_000,
+        max_retries: int = 8,
+        cache: ResponseCache | None = None,
+        **params: Any,
+    ) -> None:
+        self.client = client
+        self.cache = cache
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        # Passed on to responses.create, e.g. max_output_tokens=160 or temperature=0
+        self.params = params
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.target_requests_per_minute = requests_per_minute
+        self.paused_until = 0.0
+        self.stats = LabelingStats()
+
+    def _estimate_tokens(self, prompt: str, params: dict[str, Any]) -> int:
+        return len(prompt) // _CHARS_PER_TOKEN + 1 + (params.get("max_output_tokens") or _DEFAULT_OUTPUT_TOKENS)
+
+    # After a 429, pause everyone and halve the request rate; every success wins back a little of it
+    def _slow_down(self, delay: float) -> None:
+        self.stats.rate_limited += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.requests.per_minute = max(1.0, self.requests.per_minute / 2)
+
+    def _speed_up(self) -> None:
+        self.requests.per_minute = min(self.target_requests_per_minute, self.requests.per_minute + self.target_requests_per_minute / 100)
+
+    async def _wait_for_pause(self) -> None:
+        while (remaining := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    # `params` override the engine's for this request
+    async def label_one(self, prompt: str, **params: Any) -> LabelResult:
+        params = {**self.params, **params}
+        key = cache_key(self.model, prompt, params) if self.cache is not None else None
+        if key is not None and (cached := self.cache.get(key)) is not None:
+            self.stats.cached += 1
+            return LabelResult(cached.output_text, cached.input_tokens, cached.output_tokens, attempts=0, cached=True)
+
+        estimate = self._estimate_tokens(prompt, params)
+        for attempt in range(1, self.max_retries + 2):
+            await self._wait_for_pause()
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimate)
+            self.stats.requests += 1
+            try:
+                response = await self.client.responses.create(model=self.model, input=prompt, **params)
+            except (APIStatusError, APIConnectionError) as error:
+                # Nothing was generated, so the reserved tokens go back
+                self.tokens.consume(-estimate)
+                status = getattr(error, "status_code", None)
+                if status is not None and status != 429 and status < 500:
+                    self.stats.failed += 1
+                    return LabelResult(None, attempts=attempt, error=f"{type(error).__name__}: {error}")
+                if attempt > self.max_retries:
+                    self.stats.failed += 1
+                    return LabelResult(None, attempts=attempt, error=f"Gave up after {attempt} attempts: {error}")
+                delay = _retry_after(error) or min(_MAX_BACKOFF_SECONDS, 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                if status == 429:
+                    self._slow_down(delay)
+                else:
+                    self.stats.retried_errors += 1
+                    await asyncio.sleep(delay)
+                continue
+
+            usage = response.usage
+            input_tokens, output_tokens = (usage.input_tokens, usage.output_tokens) if usage else (0, 0)
+            if usage:
+                self.tokens.consume(input_tokens + output_tokens - estimate)
+            self.stats.input_tokens += input_tokens
+            self.stats.output_tokens += output_tokens
+            self._speed_up()
+            if key is not None:
+                self.cache.put(key, self.model, CachedResponse(response.output_text, input_tokens, output_tokens))
+            return LabelResult(response.output_text, input_tokens, output_tokens, attempt)
+
+    # Labels every prompt, calling on_result(index, result) as each one finishes (in completion order). Prompts are
+    # handed to `max_concurrency` workers from a shared iterator, so only the in-flight ones are held at any time.
+    async def label_each(
+        self, prompts: Iterable[str], on_result: Callable[[int, LabelResult], None], progress_every: int = 500, **params: Any,
+    ) -> int:
+        prompts = enumerate(prompts)
+        done = 0
+
+        async def worker():
+            nonlocal done
+            for index, prompt in prompts:
+                on_result(index, await self.label_one(prompt, **params))
+                done += 1
+                if done % progress_every == 0:
+                    self.log_progress(done)
+
+        await asyncio.gather(*(worker() for _ in range(self.max_concurrency)))
+        self.log_progress(done)
+        return done
+
+    # Labels every prompt, returning the results in the same order
+    async def label(self, prompts: Iterable[str], progress_every: int = 500) -> list[LabelResult]:
+        results: dict[int, LabelResult] = {}
+        await self.label_each(prompts, results.__setitem__, progress_every)
+        return [results[index] for index in range(len(results))]
+
+    def log_progress(self, done: int) -> None:
+        elapsed = time.monotonic() - self.stats.started
+        logger.info(
+            f"Labeled {done:,} prompts in {elapsed:.1f}s ({done / max(elapsed, 1e-9) * 60:,.0f}/min): "
+            f"{self.stats.requests:,} requests, {self.stats.cached:,} from cache, {self.stats.rate_limited:,} rate limited, {self.stats.failed:,} failed, "
+            f"{self.stats.input_tokens + self.stats.output_tokens:,} tokens"
+        )
+
+
+# Seconds from a 429's Retry-After / retry-after-ms header, if it sent one
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    if (millis := response.headers.get("retry-after-ms")) is not None:
+        return float(millis) / 1000
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Sync entry point for scripts: the rows of `frame` with llm_output, input_tokens, output_tokens, llm_error and
+# from_cache added
+def label_frame(engine: LabelingEngine, frame: pl.DataFrame, prompts: pl.Series | list[str]) -> pl.DataFrame:
+    results = asyncio.run(engine.label(list(prompts)))
+    return frame.with_columns(
+        llm_output=pl.Series([r.output_text for r in results], dtype=pl.String),
+        input_tokens=pl.Series([r.input_tokens for r in results], dtype=pl.UInt32),
+        output_tokens=pl.Series([r.output_tokens for r in results], dtype=pl.UInt32),
+        llm_error=pl.Series([r.error for r in results], dtype=pl.String),
+        from_cache=pl.Series([r.cached for r in results], dtype=pl.Boolean),
+    )
+
+
+# A minimal local Responses API (POST /v1/responses) for trying the engine out. It answers `respond(prompt)` after
+# `latency` seconds, returns 429 with a Retry-After once more than `requests_per_minute` requests arrived within the
+# last minute, and records the peak number of requests it was handling at once. Tests can enforce the same rate over a
+# shorter `window_seconds`, so being rate limited costs a second rather than a minute.
+#
+#   async with MockResponsesServer(requests_per_minute=600) as server:
+#       engine = LabelingEngine(AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0))
+class MockResponsesServer:
+    def __init__(
+        self,
+        respond: Callable[[str], str] = lambda prompt: "<output>\nNONE\n</output>",
+        latency: float = 0.05,
+        requests_per_minute: float | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        window_seconds: float = 60.0,
+    ) -> None:
+        self.respond = respond
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.window_seconds = window_seconds
+        self.host, self.port = host, port
+        self.arrivals: list[float] = []
+        self.requests = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.server: asyncio.Server | None = None
+        self.connections: set[asyncio.Task] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def __aenter__(self) -> "MockResponsesServer":
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.server.close()
+        # Idle keep-alive connections would otherwise wait for the client forever
+        for connection in self.connections:
+            connection.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def _rate_limited(self) -> float | None:
+        if self.requests_per_minute is None:
+            return None
+        now = time.monotonic()
+        self.arrivals = [t for t in self.arrivals if t > now - self.window_seconds]
+        if len(self.arrivals) >= self.requests_per_minute * self.window_seconds / 60:
+            return self.arrivals[0] + self.window_seconds - now
+        self.arrivals.append(now)
+        return None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections.add(asyncio.current_task())
+        try:
+            # Clients keep connections open, so serve requests until the client closes it
+            while request_line := await reader.readline():
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = json.loads(await reader.readexactly(int(headers.get("content-length", 0))) or b"{}")
+                status, payload, extra_headers = await self._handle(request_line.decode("latin-1").split()[1], body)
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\ncontent-type: application/json\r\n"
+                    f"content-length: {len(data)}\r\n{extra_headers}\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _handle(self, path: str, body: dict) -> tuple[int, dict, str]:
+        if not path.endswith("/responses"):
+            return 404, {"error": {"message": f"No mock for {path}", "type": "invalid_request_error"}}, ""
+        if (wait := self._rate_limited()) is not None:
+            self.rejected += 1
+            return 429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}, \
+                f"retry-after-ms: {int(wait * 1000) + 1}\r\n"
+
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            prompt = body["input"] if isinstance(body.get("input"), str) else json.dumps(body.get("input"))
+            text = self.respond(prompt)
+        finally:
+            self.in_flight -= 1
+        return 200, mock_response(body.get("model"), prompt, text, self.requests), ""
+
+
+# A Responses API response body answering `prompt` with `text`, with made-up token usage
+def mock_response(model: str, prompt: str, text: str, number: int) -> dict:
+    input_tokens, output_tokens = len(prompt) // _CHARS_PER_TOKEN + 1, len(text) // _CHARS_PER_TOKEN + 1
+    return {
+        "id": f"resp_mock_{number}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": model,
+        "status": "completed",
+        "output": [{
+            "type": "message", "id": f"msg_mock_{number}", "role": "assistant", "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens,
+            "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+async def _run_mock(args: argparse.Namespace) -> None:
+    async with MockResponsesServer(latency=args.mock_latency, requests_per_minute=args.mock_requests_per_minute) as server:
+        # The engine does its own retrying, so the client's built-in retries are turned off
+        client = AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+        engine = LabelingEngine(
+            client, max_concurrency=args.max_concurrency, requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute, max_output_tokens=160,
+            cache=ResponseCache(args.cache) if args.cache else None,
+        )
+        results = await engine.label(f"Label this post #{i}: ..." for i in range(args.prompts))
+        if engine.cache is not None:
+            stats = engine.cache.stats()
+            logger.info(f"Cache: {stats.hits:,} hits ({stats.hit_rate:.0%}), {stats.saved_tokens:,} tokens saved, {stats.entries:,} entries")
+        logger.info(
+            f"Mock server handled {server.requests:,} requests (peak {server.peak_in_flight} at once) and rejected "
+            f"{server.rejected:,}; {sum(r.error is None for r in results):,} of {len(results):,} prompts labeled"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the labeling engine against a local mock of the Responses API.")
+    parser.add_argument("--prompts", type=int, default=1000)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--requests-per-minute", type=float, default=3000, help="The engine's request limit")
+    parser.add_argument("--tokens-per-minute", type=float, default=1_000_000, help="The engine's token limit")
+    parser.add_argument("--mock-requests-per-minute", type=float, default=None, help="Make the mock answer 429 above this rate")
+    parser.add_argument("--mock-latency", type=float, default=0.05, help="Seconds the mock takes per request")
+    parser.add_argument("--cache", default=None, help="Response cache to use, e.g. data/llm_cache.sqlite")
+    asyncio.run(_run_mock(parser.parse_args()))
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import json
+import re
+from dataclasses import dataclass
+from typing import Any
+
+import polars as pl
+from loguru import logger
+from openai import AsyncOpenAI
+
+try:
+    from .llm_labeling import LabelingEngine, LabelResult, MockResponsesServer
+except ImportError:
+    from llm_labeling import LabelingEngine, LabelResult, MockResponsesServer
+
+# Packed labeling: one request classifies `pack_size` tweets instead of one, so the instruction block (which, with its
+# rules and few-shot examples, is most of every prompt) is paid for once per pack rather than once per tweet. Input
+# tokens per label drop by roughly pack_size, and so does the request count that rate limits apply to:
+#
+#   from processing.llm_packing import label_frame_packed
+#   labeled = label_frame_packed(engine, df, "tweet", IMPROVED_PROMPT_TEMPLATE, pack_size=10)
+#
+# Any single-tweet template works: its {tweet} placeholder is pointed at a numbered list of the pack's tweets, and the
+# model is asked for a JSON list of {"id", "label"} (enforced with a JSON schema when `structured`). Each response is
+# validated and split back into rows: an ID missing, repeated with different labels or given an unknown label sends
+# just that tweet through a normal single-tweet request with the unchanged template, as does a pack whose request
+# failed or whose output is not JSON. Pack IDs are 1..pack_size rather than row IDs, which would cost tokens and could
+# be mistyped.
+#
+#   python processing/llm_packing.py --prompts 2000 --pack-size 10       # against the local mock server
+
+LABELS = ("LEFT", "RIGHT", "CENTER", "MIXED", "NONE")
+# Output budget per tweet in a pack, plus the JSON around them
+_PACKED_TOKENS_PER_ITEM = 16
+_PACKED_TOKENS_BASE = 32
+
+_PACK_INSTRUCTIONS = """
+
+# BATCH
+
+The tweets to classify are listed below, each with an ID. Classify each one on its own, following the instructions
+above. The response format above is for a single tweet; instead, respond with ONLY a JSON object listing every ID
+exactly once with its label, one of {labels}:
+{{"labels": [{{"id": "1", "label": "{first}"}}, ...]}}
+
+{items}
+"""
+
+
+@dataclass
+class PackedLabel:
+    label: str | None
+    # This row's share of its request's tokens
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Labeled within a pack rather than on its own
+    packed: bool = True
+    error: str | None = None
+
+
+def pack_prompt(template: str, texts: list[str], field: str = "tweet", labels: tuple[str, ...] = LABELS) -> str:
+    instructions = template.format(**{field: "(listed under BATCH below)"}).rstrip()
+    # Templates that end by opening the answer tag for the model to complete would leave it dangling
+    instructions = instructions.removesuffix("<output>").rstrip()
+    items = "\n".join(f'<tweet id="{i}">\n{text}\n</tweet>' for i, text in enumerate(texts, start=1))
+    return instructions + _PACK_INSTRUCTIONS.format(labels=", ".join(labels), first=labels[0], items=items)
+
+
+# Responses API text format that constrains the output to the list of labels
+def packed_format(labels: tuple[str, ...] = LABELS) -> dict[str, Any]:
+    item = {
+        "type": "object",
+        "properties": {"id": {"type": "string"}, "label": {"type": "string", "enum": list(labels)}},
+        "required": ["id", "label"],
+        "additionalProperties": False,
+    }
+    schema = {
+        "type": "object",
+        "properties": {"labels": {"type": "array", "items": item}},
+        "required": ["labels"],
+        "additionalProperties": False,
+    }
+    return {"format": {"type": "json_schema", "name": "labels", "schema": schema, "strict": True}}
+
+
+# The label of each of the pack's `size` items that the output names validly, by 0-based position. Items that are
+# missing, labeled twice differently or given a label outside `labels` are left out.
+def parse_packed(output_text: str | None, size: int, labels: tuple[str, ...] = LABELS) -> dict[int, str]:
+    text = (output_text or "").strip()
+    # Tolerate a Markdown code fence or prose around the JSON when the format was not enforced
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        entries = json.loads(text[start:end + 1])["labels"] if start != -1 else []
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return {}
+    found: dict[int, str | None] = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            position = int(str(entry.get("id")).strip()) - 1
+        except ValueError:
+            continue
+        label = str(entry.get("label", "")).strip().upper()
+        if not 0 <= position < size or label not in labels:
+            continue
+        # Conflicting answers for one ID leave it unlabeled
+        found[position] = label if found.get(position, label) == label else None
+    return {position: label for position, label in found.items() if label is not None}
+
+
+# The label in a single-tweet answer: the <output> block if there is one, else the first label word in the text
+def parse_label(output_text: str | None, labels: tuple[str, ...] = LABELS) -> str | None:
+    text = (output_text or "").strip()
+    if m := re.search(r"<output>\s*(.*?)\s*(?:</output>|$)", text, flags=re.DOTALL | re.IGNORECASE):
+        text = m.group(1)
+    m = re.search(rf"\b({'|'.join(labels)})\b", text.upper())
+    return m.group(1) if m else None
+
+
+# `total` split over `parts` rows as evenly as whole tokens allow, so the rows' shares add up to the request's usage
+def _shares(total: int, parts: int) -> list[int]:
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+# Labels every text, `pack_size` at a time, returning one PackedLabel per text in order
+async def label_packed(
+    engine: LabelingEngine,
+    texts: list[str],
+    template: str,
+    pack_size: int = 10,
+    field: str = "tweet",
+    labels: tuple[str, ...] = LABELS,
+    structured: bool = True,
+) -> list[PackedLabel]:
+    if pack_size < 1:
+        raise ValueError(f"pack_size must be at least 1, got {pack_size}")
+    starts = range(0, len(texts), pack_size)
+    results: list[PackedLabel | None] = [None] * len(texts)
+    # Shares of pack tokens spent on rows the pack did not label, added to their single requests' usage
+    spent: dict[int, tuple[int, int]] = {}
+
+    def on_pack(index: int, result: LabelResult) -> None:
+        start = starts[index]
+        size = min(pack_size, len(texts) - start)
+        found = parse_packed(result.output_text, size, labels) if result.error is None else {}
+        for position, input_tokens, output_tokens in zip(range(size), _shares(result.input_tokens, size), _shares(result.output_tokens, size)):
+            if position in found:
+                results[start + position] = PackedLabel(found[position], input_tokens, output_tokens)
+            else:
+                spent[start + position] = (input_tokens, output_tokens)
+
+    params = {"max_output_tokens": _PACKED_TOKENS_BASE + _PACKED_TOKENS_PER_ITEM * pack_size}
+    if structured:
+        params["text"] = packed_format(labels)
+    await engine.label_each((pack_prompt(template, texts[s:s + pack_size], field, labels) for s in starts), on_pack, **params)
+
+    # Whatever the packs did not label goes through on its own
+    fallback = [i for i, result in enumerate(results) if result is None]
+    if fallback:
+        logger.info(f"Labeling {len(fallback):,} of {len(texts):,} rows singly after packed requests did not label them")
+
+    def on_single(index: int, result: LabelResult) -> None:
+        label = parse_label(result.output_text, labels) if result.error is None else None
+        error = result.error or (None if label is not None else f"No label in output: {result.output_text!r}")
+        input_tokens, output_tokens = spent.get(fallback[index], (0, 0))
+        results[fallback[index]] = PackedLabel(
+            label, input_tokens + result.input_tokens, output_tokens + result.output_tokens, packed=False, error=error,
+        )
+
+    await engine.label_each((template.format(**{field: texts[i]}) for i in fallback), on_single)
+    return results
+
+
+# Sync entry point for scripts: the rows of `frame` with prediction, input_tokens, output_tokens, packed and llm_error
+# added, labeling `text_column`
+def label_frame_packed(
+    engine: LabelingEngine,
+    frame: pl.DataFrame,
+    text_column: str,
+    template: str,
+    pack_size: int = 10,
+    field: str = "tweet",
+    labels: tuple[str, ...] = LABELS,
+    structured: bool = True,
+) -> pl.DataFrame:
+    results = asyncio.run(label_packed(engine, frame[text_column].to_list(), template, pack_size, field, labels, structured))
+    return frame.with_columns(
+        prediction=pl.Series([r.label for r in results], dtype=pl.String),
+        input_tokens=pl.Series([r.input_tokens for r in results], dtype=pl.UInt32),
+        output_tokens=pl.Series([r.output_tokens for r in results], dtype=pl.UInt32),
+        packed=pl.Series([r.packed for r in results], dtype=pl.Boolean),
+        llm_error=pl.Series([r.error for r in results], dtype=pl.String),
+    )
+
+
+_DEMO_TEMPLATE = """Classify the tweet's political ideology. Respond with ONLY the output tag, nothing else.
+
+LEFT = Progressive/liberal OR criticizes Republicans
+RIGHT = Conservative OR criticizes Democrats
+CENTER = Neutral analysis or reports on both sides
+MIXED = Combines left and right positions
+NONE = Not political
+
+Examples:
+"#BlackLivesMatter ride to #Ferguson has left me in awe." → <output>LEFT</output>
+"Great workout today!" → <output>NONE</output>
+
+Tweet: {tweet}
+<output>"""
+
+
+# Answers packed prompts with a JSON label list, leaving out every `drop_every`-th tweet to exercise the fallback, and
+# single prompts with an output tag
+def _mock_respond(drop_every: int):
+    def respond(prompt: str) -> str:
+        ids = re.findall(r'<tweet id="(\d+)">', prompt)
+        if not ids:
+            return "NONE</output>"
+        entries = [{"id": i, "label": LABELS[int(i) % len(LABELS)]} for i in ids if not drop_every or int(i) % drop_every]
+        return json.dumps({"labels": entries})
+    return respond
+
+
+async def _run_mock(args: argparse.Namespace) -> None:
+    texts = [f"Tweet #{i}: an opinion about something in the news, written at about the length of a real tweet." for i in range(args.prompts)]
+    for pack_size in (1, args.pack_size):
+        async with MockResponsesServer(respond=_mock_respond(args.mock_drop_every), latency=args.mock_latency) as server:
+            client = AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+            engine = LabelingEngine(client, max_concurrency=args.max_concurrency, requests_per_minute=60_000, tokens_per_minute=100_000_000, max_output_tokens=160)
+            if pack_size == 1:
+                results = [PackedLabel(parse_label(r.output_text), r.input_tokens, r.output_tokens, packed=False)
+                           for r in await engine.label(_DEMO_TEMPLATE.format(tweet=text) for text in texts)]
+            else:
+                results = await label_packed(engine, texts, _DEMO_TEMPLATE, pack_size, structured=False)
+        logger.info(
+            f"Pack size {pack_size}: {server.requests:,} requests, {sum(r.input_tokens for r in results) / len(results):,.1f} input tokens per label, "
+            f"{sum(r.packed for r in results):,} rows labeled in packs, {sum(r.label is not None for r in results):,} of {len(results):,} labeled"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare packed and one-per-request labeling against a local mock of the Responses API.")
+    parser.add_argument("--prompts", type=int, default=1000)
+    parser.add_argument("--pack-size", type=int, default=10)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--mock-latency", type=float, default=0.02, help="Seconds the mock takes per request")
+    parser.add_argument("--mock-drop-every", type=int, default=7, help="The mock leaves out every this many-th tweet of a pack (0: none)")
+    asyncio.run(_run_mock(parser.parse_args()))
@@ -0,0 +1,95 @@
+import polars as pl
+
+# One row per participant per month, combining the writing, rating and requesting trajectories:
+#   - keyed by participantId, userMonth and calendarMonth (the three tables' ID columns become participantId)
+#   - every month between a participant's first and last active month is present; months without any activity
+#     ("gap months") have activeMonth = False
+#   - counters (unsigned integer columns such as notesCreated, notesRated, requestsMade, hits, {topic}Count) are 0 in
+#     months without that activity, while averages and rates stay null, since they are undefined there
+# Built once by create_trajectories.py --panel and written like the partitioned trajectories, so
+# trajectory_store.scan_trajectories("data/user_panel", ...) prunes it by month and participant.
+# fill_gap_months does the month filling and also works on any other per-participant monthly table, e.g. in a notebook:
+#   from processing.participant_panel import fill_gap_months
+#   panel = fill_gap_months(user_months, "participantId", through="2026-01")
+
+_ID_COLUMNS = ("noteAuthorParticipantId", "raterParticipantId", "requesterParticipantId")
+
+
+# Months since year 0 for a "YYYY-MM" column, and back
+def calendar_index(calendar_month: pl.Expr) -> pl.Expr:
+    return calendar_month.str.slice(0, 4).cast(pl.Int32) * 12 + calendar_month.str.slice(5, 2).cast(pl.Int32) - 1
+
+
+def calendar_month(index: pl.Expr) -> pl.Expr:
+    return pl.format("{}-{}", index // 12, (index % 12 + 1).cast(pl.String).str.zfill(2))
+
+
+# Give every participant one row per month from their first active month to their last one (or to `through`, a
+# "YYYY-MM" calendar month, for all participants), with the rows of `frame` in place and activeMonth marking them.
+# `frame` has one row per (id_column, userMonth) plus calendarMonth; IDs may be strings or interned keys.
+#
+# This replaces the cross join of all users with all months: each participant's range is expanded directly with
+# int_ranges, and the observed rows are scattered into it by position (the participant's offset in the output plus
+# userMonth - firstMonth), so no intermediate is larger than the filled panel itself and nothing is joined.
+# Columns selected by `zero_fill` (by default unsigned integers, i.e. counters) are 0 in filled months; all other
+# value columns are null there.
+def fill_gap_months(
+    frame: pl.DataFrame, id_column: str, through: str | None = None, zero_fill=pl.selectors.unsigned_integer(),
+) -> pl.DataFrame:
+    keys = [id_column, "userMonth", "calendarMonth"]
+    frame = frame.sort(id_column, "userMonth")
+
+    spans = frame.group_by(id_column, maintain_order=True).agg(
+        # calendarMonth - userMonth is the same for every row of a participant: their first calendar month
+        _firstCalendarIndex=(calendar_index(pl.col("calendarMonth")) - pl.col("userMonth")).first(),
+        _firstMonth=pl.col("userMonth").min(),
+        _lastMonth=pl.col("userMonth").max(),
+        _rows=pl.len(),
+    )
+    if through is not None:
+        spans = spans.with_columns(
+            _lastMonth=pl.max_horizontal("_lastMonth", calendar_index(pl.lit(through)) - pl.col("_firstCalendarIndex"))
+        )
+    spans = spans.with_columns(_length=pl.col("_lastMonth") - pl.col("_firstMonth") + 1).with_columns(
+        _offset=pl.col("_length").cum_sum() - pl.col("_length")
+    )
+
+    filled = (
+        spans
+        .with_columns(userMonth=pl.int_ranges("_firstMonth", pl.col("_lastMonth") + 1, dtype=pl.Int32))
+        .explode("userMonth")
+        .select(id_column, "userMonth", calendarMonth=calendar_month(pl.col("_firstCalendarIndex") + pl.col("userMonth")))
+    )
+
+    # frame and spans are both in participant order, so repeating each span by its row count lines them up
+    position = (
+        spans.select(
+            pl.col("_offset").repeat_by("_rows").explode() - pl.col("_firstMonth").repeat_by("_rows").explode()
+        ).to_series()
+        + frame["userMonth"]
+    )
+    values = frame.drop(keys).with_columns(activeMonth=pl.lit(True))
+    columns = [
+        pl.repeat(None, len(filled), dtype=values[name].dtype, eager=True).alias(name).scatter(position, values[name])
+        for name in values.columns
+    ]
+    return (
+        filled
+        .with_columns(columns)
+        .with_columns(pl.col("activeMonth").fill_null(False), (zero_fill & pl.selectors.exclude(keys)).fill_null(0))
+        .select(*keys, "activeMonth", pl.all().exclude(*keys, "activeMonth"))
+    )
+
+
+def build_panel(user_notes: pl.DataFrame, user_ratings: pl.DataFrame, user_requests: pl.DataFrame) -> pl.DataFrame:
+    keys = ["participantId", "userMonth", "calendarMonth"]
+    trajectories = [
+        traj.rename({column: "participantId" for column in _ID_COLUMNS if column in traj.columns})
+        for traj in (user_notes, user_ratings, user_requests)
+    ]
+    active = (
+        trajectories[0]
+        .join(trajectories[1], on=keys, how="full", coalesce=True, validate="1:1")
+        .join(trajectories[2], on=keys, how="full", coalesce=True, validate="1:1")
+    )
+    return fill_gap_months(active, "participantId")
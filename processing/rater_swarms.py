@@ -0,0 +1,155 @@
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+from loguru import logger
+
+from instrumentation import measure
+
+# Rater swarms: notes that draw a burst of ratings within a short time. For every note and every window width W this
+# finds the largest number of ratings in any W-minute window (not just over the note's whole history), and where that
+# window lies. Notes reaching `min_ratings` in some W-minute window are swarms for W; the raters inside the densest
+# window are its members, and rater_cooccurrence counts how often two raters show up in the same swarms.
+#
+#   python processing/rater_swarms.py --windows 10 60 --min-ratings 20 --buckets 8
+#
+# writes data/rater_swarms/{notes,members,cooccurrence}.parquet. Only noteId, raterParticipantId and createdAtMillis
+# are read, and with --buckets the notes are processed in hash buckets (one streaming pass each), so the full ratings
+# dump never has to be in memory at once.
+
+SWARM_WINDOWS_MINUTES = (10, 60)
+SWARM_MIN_RATINGS = 20
+_RATINGS_PATH = "data/2026-02-03/noteRatings.parquet"
+_OUTPUT_DIR = "data/rater_swarms"
+
+
+# For each rating (sorted by note, then time), the index of the note's earliest rating at most `width` ms before it:
+# the left pointer of a two-pointer scan, found for all ratings at once. Notes are laid end to end on one time axis
+# with more than the largest width between them, so a window never reaches into the previous note.
+def _window_starts(note_starts: np.ndarray, times: np.ndarray, widths: list[int]) -> list[np.ndarray]:
+    sizes = np.diff(np.append(note_starts, len(times)))
+    first = times[note_starts]
+    spans = times[np.append(note_starts[1:], len(times)) - 1] - first
+    bases = np.cumsum(spans + max(widths) + 1) - (spans + max(widths) + 1)
+    axis = times - np.repeat(first - bases, sizes)
+    return [np.searchsorted(axis, axis - width, side="left") for width in widths]
+
+
+# Per note: ratings, and for each window W the most ratings in any W-minute window (maxRatings{W}m) with that window's
+# first and last rating time (swarmStartMillis{W}m, swarmEndMillis{W}m). Plus the member raters of every note with at
+# least `min_ratings` in a window, as (noteId, windowMinutes, raterParticipantId).
+# `ratings` must be sorted by noteId, then createdAtMillis.
+def detect_swarms(
+    ratings: pl.DataFrame,
+    windows_minutes: tuple[int, ...] = SWARM_WINDOWS_MINUTES,
+    min_ratings: int = SWARM_MIN_RATINGS,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    if ratings.is_empty():
+        return _empty_swarms(ratings, windows_minutes)
+    times = ratings["createdAtMillis"].to_numpy()
+    note_starts = np.flatnonzero(ratings["noteId"].ne_missing(ratings["noteId"].shift(1)).to_numpy())
+    sizes = np.diff(np.append(note_starts, len(times)))
+    note_index = np.repeat(np.arange(len(note_starts)), sizes)
+    rows = np.arange(len(times))
+
+    notes = pl.DataFrame({
+        "noteId": ratings["noteId"].gather(note_starts),
+        "ratings": pl.Series(sizes, dtype=pl.UInt32),
+        "firstRatingMillis": times[note_starts],
+        "lastRatingMillis": times[np.append(note_starts[1:], len(times)) - 1],
+    })
+    members = []
+    for minutes, starts in zip(windows_minutes, _window_starts(note_starts, times, [w * 60_000 for w in windows_minutes])):
+        counts = rows - starts + 1
+        most = np.maximum.reduceat(counts, note_starts) if len(note_starts) else counts
+        # The first rating ending a densest window, one per note
+        ends = np.flatnonzero(counts == most[note_index])
+        ends = ends[np.unique(note_index[ends], return_index=True)[1]]
+        notes = notes.with_columns(
+            pl.Series(f"maxRatings{minutes}m", most, dtype=pl.UInt32),
+            pl.Series(f"swarmStartMillis{minutes}m", times[starts[ends]]),
+            pl.Series(f"swarmEndMillis{minutes}m", times[ends]),
+        )
+
+        swarm_ends = ends[most >= min_ratings]
+        lengths = swarm_ends - starts[swarm_ends] + 1
+        offsets = np.cumsum(lengths) - lengths
+        member_rows = np.arange(lengths.sum()) - np.repeat(offsets - starts[swarm_ends], lengths)
+        members.append(
+            ratings[member_rows].select("noteId", "raterParticipantId").unique(maintain_order=True)
+            .select("noteId", windowMinutes=pl.lit(minutes, pl.UInt16), raterParticipantId="raterParticipantId")
+        )
+    return notes, pl.concat(members)
+
+
+# detect_swarms' frames without any notes, with the columns and types of `ratings`
+def _empty_swarms(ratings: pl.DataFrame, windows_minutes: tuple[int, ...]) -> tuple[pl.DataFrame, pl.DataFrame]:
+    note_id, rater_id, millis = (ratings.schema[c] for c in ("noteId", "raterParticipantId", "createdAtMillis"))
+    notes = pl.Schema({"noteId": note_id, "ratings": pl.UInt32, "firstRatingMillis": millis, "lastRatingMillis": millis})
+    for minutes in windows_minutes:
+        notes.update({f"maxRatings{minutes}m": pl.UInt32, f"swarmStartMillis{minutes}m": millis, f"swarmEndMillis{minutes}m": millis})
+    members = pl.Schema({"noteId": note_id, "windowMinutes": pl.UInt16, "raterParticipantId": rater_id})
+    return pl.DataFrame(schema=notes), pl.DataFrame(schema=members)
+
+
+# detect_swarms over a ratings file (or lazy frame), `buckets` notes hash buckets at a time
+def scan_swarms(
+    ratings: str | pl.LazyFrame,
+    windows_minutes: tuple[int, ...] = SWARM_WINDOWS_MINUTES,
+    min_ratings: int = SWARM_MIN_RATINGS,
+    buckets: int = 1,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    ratings = pl.scan_parquet(ratings) if isinstance(ratings, str) else ratings
+    ratings = ratings.select("noteId", "raterParticipantId", "createdAtMillis")
+    parts = []
+    for bucket in range(buckets):
+        in_bucket = ratings.filter(pl.col("noteId").hash(0) % buckets == bucket) if buckets > 1 else ratings
+        in_bucket = in_bucket.sort("noteId", "createdAtMillis").collect(engine="streaming")
+        # With many buckets over few notes, some hold none
+        if len(in_bucket):
+            parts.append(detect_swarms(in_bucket, windows_minutes, min_ratings))
+        logger.debug(f"Scanned swarm bucket {bucket + 1}/{buckets}")
+    if not parts:
+        return _empty_swarms(in_bucket, windows_minutes)
+    notes, members = (pl.concat(frames) for frames in zip(*parts))
+    return notes.sort("noteId"), members.sort("windowMinutes", "noteId", "raterParticipantId")
+
+
+# Sparse rater x rater counts of shared swarms for one window width: one row per pair of raters that were members of
+# at least one common swarm, with raterA < raterB
+def rater_cooccurrence(members: pl.DataFrame | pl.LazyFrame, window_minutes: int) -> pl.DataFrame | pl.LazyFrame:
+    swarm_members = members.filter(pl.col("windowMinutes") == window_minutes).select("noteId", "raterParticipantId")
+    return (
+        swarm_members.rename({"raterParticipantId": "raterA"})
+        .join(swarm_members.rename({"raterParticipantId": "raterB"}), on="noteId")
+        .filter(pl.col("raterA") < pl.col("raterB"))
+        .group_by("raterA", "raterB")
+        .agg(sharedSwarms=pl.len().cast(pl.UInt32))
+        .sort("raterA", "raterB")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find rater swarms: notes rated in bursts within sliding time windows.")
+    parser.add_argument("--ratings", default=_RATINGS_PATH)
+    parser.add_argument("--windows", type=int, nargs="+", default=list(SWARM_WINDOWS_MINUTES), help="Window widths in minutes")
+    parser.add_argument("--min-ratings", type=int, default=SWARM_MIN_RATINGS, help="Ratings within a window that make a swarm")
+    parser.add_argument("--buckets", type=int, default=1, help="Process notes in this many hash buckets to bound memory")
+    parser.add_argument(
+        "--cooccurrence-window", type=int, default=None,
+        help="Window whose swarms the rater co-occurrence table is built from (default: the widest)",
+    )
+    parser.add_argument("--output-dir", default=_OUTPUT_DIR)
+    args = parser.parse_args()
+
+    with measure("rater_swarms"):
+        notes, members = scan_swarms(args.ratings, tuple(args.windows), args.min_ratings, args.buckets)
+        cooccurrence = rater_cooccurrence(members.lazy(), args.cooccurrence_window or max(args.windows)).collect(engine="streaming")
+    os.makedirs(args.output_dir, exist_ok=True)
+    notes.write_parquet(f"{args.output_dir}/notes.parquet")
+    members.write_parquet(f"{args.output_dir}/members.parquet")
+    cooccurrence.write_parquet(f"{args.output_dir}/cooccurrence.parquet")
+    for minutes in args.windows:
+        logger.info(f"{(notes[f'maxRatings{minutes}m'] >= args.min_ratings).sum():,} of {len(notes):,} notes are {minutes}-minute swarms")
+    logger.info(f"Wrote swarm notes, {len(members):,} swarm memberships and {len(cooccurrence):,} co-rating rater pairs to {args.output_dir}")
@@ -0,0 +1,226 @@
+import argparse
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+from multiprocessing import get_context
+
+import polars as pl
+from loguru import logger
+
+from instrumentation import measure
+from rater_swarms import SWARM_MIN_RATINGS, detect_swarms
+
+# Per-rating feature flags over the full ratings dump, without loading it:
+#   - is_rating_session:     the rater made another rating within --session-gap minutes before or after this one
+#   - is_same_post_interest: the rater rated more than one note on this post (ratedOnTweetId)
+#   - is_notification:       the rating came from a notification (fromNotification, missing counts as False)
+#   - is_rater_swarm:        the note drew at least --min-ratings ratings within some --swarm-window minutes
+#
+#   python processing/rating_flags.py --workers 8
+#
+# The ratings are read in chunks of --chunk-rows rows (Parquet row groups outside a chunk are skipped) by parallel
+# workers, in two passes:
+#   1. Each chunk is reduced to partial aggregates keyed by (rater, session-gap time bucket), (rater, post) and
+#      (note, swarm-window time bucket), which are merged as they come in. Memory grows with these keys, not with rows.
+#   2. The merged aggregates are narrowed down to the keys that set a flag: session buckets, posts a rater rated
+#      repeatedly and swarm notes. Each chunk is read again, joined with these and its flags written to
+#      data/rating_flags/part-NNNNN.parquet (noteId, raterParticipantId plus the four flags, in file order).
+# Sessions come out exact from the buckets: two ratings in one bucket are less than a gap apart, and otherwise only the
+# last rating of the bucket before and the first of the bucket after can be close enough. For swarms, a window spans
+# at most two adjacent buckets, so only notes with that many ratings in two adjacent buckets are candidates; their
+# ratings are then read and checked exactly with rater_swarms.detect_swarms.
+
+_RATINGS_PATH = "data/2026-02-03/noteRatings.parquet"
+_OUTPUT_DIR = "data/rating_flags"
+_SESSION_GAP_MINUTES = 5
+_SWARM_WINDOW_MINUTES = 60
+_FLAGS = ("is_rating_session", "is_same_post_interest", "is_notification", "is_rater_swarm")
+
+
+def _read_chunk(path: str, offset: int, rows: int) -> pl.DataFrame:
+    return (
+        pl.scan_parquet(path)
+        .slice(offset, rows)
+        .select("noteId", "raterParticipantId", "createdAtMillis", "ratedOnTweetId", "fromNotification")
+        .collect()
+    )
+
+
+# Pass 1, in a worker: the chunk's partial aggregates
+def _partials(path: str, offset: int, rows: int, session_ms: int, swarm_ms: int) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    ratings = _read_chunk(path, offset, rows)
+    sessions = ratings.group_by("raterParticipantId", _sessionBucket=pl.col("createdAtMillis") // session_ms).agg(
+        _ratings=pl.len(), _firstMillis=pl.col("createdAtMillis").min(), _lastMillis=pl.col("createdAtMillis").max(),
+    )
+    posts = ratings.group_by("raterParticipantId", "ratedOnTweetId").agg(_ratings=pl.len())
+    notes = ratings.group_by("noteId", _swarmBucket=pl.col("createdAtMillis") // swarm_ms).agg(_ratings=pl.len())
+    return sessions, posts, notes
+
+
+def _merge(partials: list[tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]]) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    sessions, posts, notes = (pl.concat(frames).lazy() for frames in zip(*partials))
+    return tuple(pl.collect_all([
+        sessions.group_by("raterParticipantId", "_sessionBucket").agg(
+            pl.col("_ratings").sum(), pl.col("_firstMillis").min(), pl.col("_lastMillis").max(),
+        ),
+        posts.group_by("raterParticipantId", "ratedOnTweetId").agg(pl.col("_ratings").sum()),
+        notes.group_by("noteId", "_swarmBucket").agg(pl.col("_ratings").sum()),
+    ], engine="streaming"))
+
+
+# (rater, session bucket) pairs whose ratings are all in a session: buckets with more than one rating, and single
+# ratings with the previous bucket's last or the next bucket's first rating close enough
+def _session_buckets(sessions: pl.DataFrame, session_ms: int) -> pl.DataFrame:
+    same_rater = pl.col("raterParticipantId")
+    return (
+        sessions.sort("raterParticipantId", "_sessionBucket")
+        .with_columns(
+            _prevLast=pl.when((same_rater == same_rater.shift(1)) & (pl.col("_sessionBucket").diff() == 1)).then(pl.col("_lastMillis").shift(1)),
+            _nextFirst=pl.when((same_rater == same_rater.shift(-1)) & (pl.col("_sessionBucket").diff(-1) == -1)).then(pl.col("_firstMillis").shift(-1)),
+        )
+        .filter(
+            (pl.col("_ratings") > 1)
+            | (pl.col("_firstMillis") - pl.col("_prevLast") <= session_ms)
+            | (pl.col("_nextFirst") - pl.col("_lastMillis") <= session_ms)
+        )
+        .select("raterParticipantId", "_sessionBucket")
+    )
+
+
+# Notes with at least `min_ratings` ratings within `swarm_ms` of each other, checked exactly on the candidates
+def _swarm_notes(path: str, notes: pl.DataFrame, swarm_ms: int, min_ratings: int) -> pl.DataFrame:
+    candidates = (
+        notes.join(
+            notes.select("noteId", _swarmBucket=pl.col("_swarmBucket") - 1, _nextRatings="_ratings"),
+            on=["noteId", "_swarmBucket"], how="left",
+        )
+        .filter(pl.col("_ratings") + pl.col("_nextRatings").fill_null(0) >= min_ratings)
+        .select("noteId").unique()
+    )
+    if candidates.is_empty():
+        logger.info("No swarm candidate notes")
+        return candidates
+    ratings = (
+        pl.scan_parquet(path)
+        .select("noteId", "raterParticipantId", "createdAtMillis")
+        .join(candidates.lazy(), on="noteId", how="semi")
+        .sort("noteId", "createdAtMillis")
+        .collect(engine="streaming")
+    )
+    window_minutes = swarm_ms // 60_000
+    swarms, _ = detect_swarms(ratings, (window_minutes,), min_ratings)
+    logger.info(f"Checked {len(candidates):,} swarm candidate notes ({len(ratings):,} ratings)")
+    return swarms.filter(pl.col(f"maxRatings{window_minutes}m") >= min_ratings).select("noteId")
+
+
+# The merged aggregates, read once per worker process
+@cache
+def _tables(tables_dir: str) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    return tuple(pl.read_parquet(f"{tables_dir}/{name}.parquet") for name in ("session_buckets", "repeat_posts", "swarm_notes"))
+
+
+# Pass 2, in a worker: the chunk's flags, written to `part_path`
+def _write_flags(path: str, offset: int, rows: int, session_ms: int, tables_dir: str, part_path: str) -> dict[str, int]:
+    session_buckets, repeat_posts, swarm_notes = _tables(tables_dir)
+    ratings = _read_chunk(path, offset, rows).with_columns(_sessionBucket=pl.col("createdAtMillis") // session_ms)
+    flags = (
+        ratings
+        .join(session_buckets.with_columns(_session=pl.lit(True)), on=["raterParticipantId", "_sessionBucket"], how="left", maintain_order="left")
+        .join(repeat_posts.with_columns(_repeatPost=pl.lit(True)), on=["raterParticipantId", "ratedOnTweetId"], how="left", maintain_order="left")
+        .join(swarm_notes.with_columns(_swarm=pl.lit(True)), on="noteId", how="left", maintain_order="left")
+        .select(
+            "noteId",
+            "raterParticipantId",
+            is_rating_session=pl.col("_session").fill_null(False),
+            is_same_post_interest=pl.col("_repeatPost").fill_null(False),
+            is_notification=pl.col("fromNotification").fill_null(False).cast(pl.Boolean),
+            is_rater_swarm=pl.col("_swarm").fill_null(False),
+        )
+    )
+    flags.write_parquet(part_path)
+    return {"rows": len(flags), **flags.select(pl.col(_FLAGS).sum()).row(0, named=True)}
+
+
+def extract_rating_flags(
+    path: str = _RATINGS_PATH,
+    output_dir: str = _OUTPUT_DIR,
+    workers: int = 1,
+    chunk_rows: int = 5_000_000,
+    session_gap_minutes: int = _SESSION_GAP_MINUTES,
+    swarm_window_minutes: int = _SWARM_WINDOW_MINUTES,
+    min_ratings: int = SWARM_MIN_RATINGS,
+) -> dict[str, int]:
+    session_ms, swarm_ms = session_gap_minutes * 60_000, swarm_window_minutes * 60_000
+    total = pl.scan_parquet(path).select(pl.len()).collect().item()
+    tmp = f"{output_dir}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        counts = _extract(path, tmp, workers, chunk_rows, total, session_ms, swarm_ms, min_ratings)
+    except BaseException:
+        # Never leave a half-written directory behind
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp, output_dir)
+    return counts
+
+
+# Both passes, writing the flag parts to `tmp`
+def _extract(
+    path: str, tmp: str, workers: int, chunk_rows: int, total: int, session_ms: int, swarm_ms: int, min_ratings: int,
+) -> dict[str, int]:
+    # At least one chunk, so an empty dump yields an empty part rather than nothing to merge
+    offsets = list(range(0, max(total, 1), chunk_rows))
+    tables_dir = tempfile.mkdtemp(prefix="tables-", dir=tmp)
+
+    # Spawned rather than forked: forking a process that has already started Polars' thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        with measure("rating_flag_partials"):
+            n = len(offsets)
+            # Partials are merged whenever the unmerged ones outgrow the merged tables, so each key is re-aggregated
+            # only a logarithmic number of times and memory stays within a small multiple of the number of keys
+            merged, pending = None, []
+            for partials in pool.map(_partials, [path] * n, offsets, [chunk_rows] * n, [session_ms] * n, [swarm_ms] * n):
+                if merged is None:
+                    merged = partials
+                    continue
+                pending.append(partials)
+                if sum(len(frame) for frames in pending for frame in frames) >= sum(len(frame) for frame in merged):
+                    merged, pending = _merge([merged, *pending]), []
+            sessions, posts, notes = _merge([merged, *pending]) if pending else merged
+        _session_buckets(sessions, session_ms).write_parquet(f"{tables_dir}/session_buckets.parquet")
+        posts.filter(pl.col("_ratings") > 1).select("raterParticipantId", "ratedOnTweetId").write_parquet(f"{tables_dir}/repeat_posts.parquet")
+        with measure("rating_flag_swarms"):
+            _swarm_notes(path, notes, swarm_ms, min_ratings).write_parquet(f"{tables_dir}/swarm_notes.parquet")
+        logger.info(f"Merged partial aggregates: {len(sessions):,} rater session buckets, {len(posts):,} rater-post pairs, {len(notes):,} note buckets")
+        del sessions, posts, notes
+
+        with measure("rating_flag_write"):
+            parts = [f"{tmp}/part-{i:05d}.parquet" for i in range(n)]
+            counts = list(pool.map(_write_flags, [path] * n, offsets, [chunk_rows] * n, [session_ms] * n, [tables_dir] * n, parts))
+
+    shutil.rmtree(tables_dir)
+    return {key: sum(count[key] for count in counts) for key in ("rows", *_FLAGS)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flag ratings made in sessions, on repeat posts, from notifications and in rater swarms.")
+    parser.add_argument("--ratings", default=_RATINGS_PATH)
+    parser.add_argument("--output-dir", default=_OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes reading chunks in parallel")
+    parser.add_argument("--chunk-rows", type=int, default=5_000_000, help="Rows per chunk; each worker holds one chunk at a time")
+    parser.add_argument("--session-gap", type=int, default=_SESSION_GAP_MINUTES, help="Minutes between ratings within a session")
+    parser.add_argument("--swarm-window", type=int, default=_SWARM_WINDOW_MINUTES, help="Minutes a swarm's ratings fall within")
+    parser.add_argument("--min-ratings", type=int, default=SWARM_MIN_RATINGS, help="Ratings within --swarm-window that make a swarm")
+    args = parser.parse_args()
+
+    counts = extract_rating_flags(
+        args.ratings, args.output_dir, args.workers, args.chunk_rows, args.session_gap, args.swarm_window, args.min_ratings,
+    )
+    logger.info(
+        f"Wrote flags for {counts['rows']:,} ratings to {args.output_dir}: "
+        + ", ".join(f"{flag} {counts[flag] / max(counts['rows'], 1):.2%}" for flag in _FLAGS)
+    )
@@ -0,0 +1,84 @@
+import polars as pl
+
+# Rating sessions: a rater's consecutive ratings no more than `gap` minutes apart. The ratings are sorted by rater and
+# time once, and the gap to the previous rating is compared with every threshold in the same pass, so several
+# definitions of a session come out of one sort instead of one per threshold (or per analysis script):
+#
+#   from processing.rating_sessions import sessionize, session_stats
+#   ratings = sessionize(pl.read_parquet("data/2026-02-03/noteRatings.parquet"), gaps_minutes=(5, 30))
+#   ratings.filter(pl.col("sessionLength5m") > 1)     # the ratings made in a session of two or more, within 5 minutes
+#   sessions = session_stats(ratings, 5)              # one row per session
+#
+# Column names carry the threshold, e.g. sessionId5m / sessionLength5m for 5 minutes.
+
+SESSION_GAPS_MINUTES = (5, 30)
+
+
+def session_suffix(gap_minutes: float) -> str:
+    return f"{gap_minutes:g}m"
+
+
+# Adds, per rating:
+#   - gapSeconds: seconds since the rater's previous rating (null for their first)
+#   - sessionId{gap}m: session number, unique within the frame; a session starts at a rater's first rating and after
+#     every gap of more than `gap` minutes
+#   - sessionLength{gap}m: number of ratings in that session
+# Returns the ratings sorted by rater and time.
+def sessionize(
+    ratings: pl.DataFrame | pl.LazyFrame,
+    gaps_minutes: tuple[float, ...] = SESSION_GAPS_MINUTES,
+    id_column: str = "raterParticipantId",
+    time_column: str = "createdAtMillis",
+) -> pl.DataFrame | pl.LazyFrame:
+    same_rater = pl.col(id_column) == pl.col(id_column).shift(1)
+    ratings = ratings.sort(id_column, time_column).with_columns(
+        gapSeconds=pl.when(same_rater).then(pl.col(time_column) - pl.col(time_column).shift(1)) / 1000
+    )
+    session_ids = {
+        f"sessionId{session_suffix(gap)}": (pl.col("gapSeconds").is_null() | (pl.col("gapSeconds") > gap * 60)).cum_sum().cast(pl.UInt32)
+        for gap in gaps_minutes
+    }
+    return ratings.with_columns(**session_ids).with_columns(
+        pl.len().over(name).cast(pl.UInt32).alias(name.replace("sessionId", "sessionLength")) for name in session_ids
+    )
+
+
+# One row per session of a sessionized frame: the rater, start and end time, number of ratings, duration and the
+# median gap between its ratings. `first` columns (e.g. userMonth) are taken from the session's first rating.
+def session_stats(
+    sessionized: pl.DataFrame | pl.LazyFrame,
+    gap_minutes: float,
+    id_column: str = "raterParticipantId",
+    time_column: str = "createdAtMillis",
+    first: tuple[str, ...] = (),
+) -> pl.DataFrame | pl.LazyFrame:
+    session_id = f"sessionId{session_suffix(gap_minutes)}"
+    return sessionized.group_by(session_id, maintain_order=True).agg(
+        pl.col(id_column).first(),
+        *[pl.col(name).first() for name in first],
+        startMillis=pl.col(time_column).first(),
+        endMillis=pl.col(time_column).last(),
+        ratings=pl.len().cast(pl.UInt32),
+        durationSeconds=(pl.col(time_column).last() - pl.col(time_column).first()) / 1000,
+        # The first rating's gap leads into the session, not through it
+        medianGapSeconds=pl.col("gapSeconds").slice(1).median(),
+    )
+
+
+# Per rater and userMonth: the number of sessions started that month and their average number of ratings, for every
+# threshold (numRatingSessions5m, avgPostsRatedPerSession5m, ...). A session running past the end of a month counts
+# towards the month it started in, so rater-months whose ratings all continue an earlier session have 0 sessions.
+def monthly_session_aggregates(
+    ratings: pl.DataFrame | pl.LazyFrame,
+    gaps_minutes: tuple[float, ...] = SESSION_GAPS_MINUTES,
+    id_column: str = "raterParticipantId",
+    time_column: str = "createdAtMillis",
+) -> pl.DataFrame | pl.LazyFrame:
+    sessionized = sessionize(ratings.select(id_column, "userMonth", time_column), gaps_minutes, id_column, time_column)
+    aggregates = {}
+    for gap in gaps_minutes:
+        suffix = session_suffix(gap)
+        starts = pl.col("gapSeconds").is_null() | (pl.col("gapSeconds") > gap * 60)
+        aggregates[f"numRatingSessions{suffix}"] = starts.sum().cast(pl.UInt32)
+        aggregates[f"avgPostsRatedPerSession{suffix}"] = pl.col(f"sessionLength{suffix}").filter(starts).mean()
+    return sessionized.group_by(id_column, "userMonth").agg(**aggregates)
@@ -0,0 +1,66 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from instrumentation import StageStats, measure
+
+# Minimal stage DAG runner. Each stage names the values it reads and the values it produces; a stage is started as
+# soon as all of its inputs exist, so independent stages (loading files, building reference tables, per-table
+# aggregations) overlap. Polars releases the GIL while it works, so plain threads are enough to keep cores busy.
+# Every stage is measured and logged through instrumentation.measure.
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[..., Any]
+    inputs: tuple[str, ...] = ()
+    # A stage with one output returns it directly, a stage with several returns a tuple in this order
+    outputs: tuple[str, ...] = ()
+
+
+def _check(stages: list[Stage], initial: dict[str, Any]) -> None:
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers or output in initial:
+                raise ValueError(f"Value {output!r} is produced by both {producers.get(output, 'the initial values')} and {stage.name}")
+            producers[output] = stage.name
+    for stage in stages:
+        if missing := [i for i in stage.inputs if i not in producers and i not in initial]:
+            raise ValueError(f"Stage {stage.name} reads {missing}, which nothing produces")
+
+
+def run_stages(
+    stages: list[Stage], initial: dict[str, Any] | None = None, max_workers: int | None = None,
+) -> tuple[dict[str, Any], list[StageStats]]:
+    values = dict(initial or {})
+    _check(stages, values)
+
+    pending = list(stages)
+    running: dict[Future, Stage] = {}
+    timings = []
+
+    def call(stage: Stage) -> tuple[Any, StageStats]:
+        inputs = [values[i] for i in stage.inputs]
+        with measure(stage.name, inputs) as stats:
+            result = stage.fn(*inputs)
+            stats.record_outputs(result)
+        return result, stats
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        while pending or running:
+            for stage in [s for s in pending if all(i in values for i in s.inputs)]:
+                pending.remove(stage)
+                running[pool.submit(call, stage)] = stage
+            if not running:
+                raise RuntimeError(f"Stages {[s.name for s in pending]} can never run (dependency cycle)")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                result, stats = future.result()
+                values.update(zip(stage.outputs, result if len(stage.outputs) > 1 else (result,)))
+                timings.append(stats)
+    return values, timings
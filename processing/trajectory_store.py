@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+from hashlib import blake2b
+
+import polars as pl
+
+# Hive-partitioned layout for the user_*_traj tables, e.g.
+#   data/user_rating_traj/calendarMonth=2024-01/participantBucket=7/00000000.parquet
+# plus a _layout.json describing how the directory was partitioned, so readers can prune without guessing.
+#
+# From a notebook at the repo root:
+#   from processing.trajectory_store import scan_trajectories
+#   scan_trajectories("data/user_rating_traj", calendar_months=("2024-01", "2024-06"), columns=["notesRated"])
+
+PARTITION_KEYS = ("calendarMonth", "participantBucket")
+_HIVE_SCHEMA = {"calendarMonth": pl.String, "participantBucket": pl.UInt32}
+
+
+# 64-bit hash of each ID. Unlike Expr.hash this is stable across Polars versions and machines,
+# which matters because bucket numbers end up in directory names.
+def stable_hash(ids: pl.Series, salt: str = "") -> pl.Series:
+    unique = ids.unique()
+    hashed = pl.Series(
+        [int.from_bytes(blake2b(f"{salt}{i}".encode("utf-8"), digest_size=8).digest(), "big") for i in unique.to_list()],
+        dtype=pl.UInt64,
+    )
+    lookup = pl.DataFrame({"id": unique, "hash": hashed})
+    return ids.to_frame("id").join(lookup, on="id", how="left", maintain_order="left")["hash"].alias(ids.name)
+
+
+def participant_bucket(ids: pl.Series, buckets: int) -> pl.Series:
+    return (stable_hash(ids) % buckets).cast(pl.UInt32).alias("participantBucket")
+
+
+def write_partitioned(
+    traj: pl.DataFrame,
+    root: str,
+    id_column: str,
+    partition_by: list[str],
+    buckets: int = 32,
+    row_group_size: int = 50_000,
+    months_from: str | None = None,
+) -> None:
+    if unknown := set(partition_by) - set(PARTITION_KEYS):
+        raise ValueError(f"Unknown partition keys {sorted(unknown)}, expected some of {PARTITION_KEYS}")
+    layout = {"idColumn": id_column, "partitionBy": partition_by, "buckets": buckets}
+
+    if "participantBucket" in partition_by:
+        traj = traj.with_columns(participant_bucket(traj[id_column], buckets))
+    # Sorting by participant inside every partition keeps each row group's id min/max range narrow,
+    # so participant filters can skip row groups using the statistics alone
+    traj = traj.sort(*partition_by, id_column, "userMonth")
+
+    # With `months_from` (incremental runs), months before it are left as written when the directory already has the
+    # same layout with calendarMonth outermost; otherwise the whole directory is rewritten
+    if months_from is not None and partition_by[:1] == ["calendarMonth"] and _read_layout(root) == layout:
+        _replace_months(traj.filter(pl.col("calendarMonth") >= months_from), root, partition_by, months_from, row_group_size)
+        return
+
+    # Written next to the destination and swapped in, so a failed write never leaves a half-updated directory
+    tmp = f"{root}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    traj.write_parquet(tmp, partition_by=partition_by, row_group_size=row_group_size, statistics=True, mkdir=True)
+    with open(f"{tmp}/_layout.json", "w") as f:
+        json.dump(layout, f)
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
+
+
+def _read_layout(root: str) -> dict | None:
+    if not os.path.exists(f"{root}/_layout.json"):
+        return None
+    with open(f"{root}/_layout.json") as f:
+        return json.load(f)
+
+
+# Rewrites the calendarMonth=... directories from `months_from` on, each swapped in whole. A failure part way leaves
+# some months old and some new, which the next run (from the same watermark) rewrites again.
+def _replace_months(traj: pl.DataFrame, root: str, partition_by: list[str], months_from: str, row_group_size: int) -> None:
+    tmp = f"{root}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    # An empty frame writes no directory at all
+    traj.write_parquet(tmp, partition_by=partition_by, row_group_size=row_group_size, statistics=True, mkdir=True)
+    written = set(os.listdir(tmp)) if os.path.isdir(tmp) else set()
+    for name in os.listdir(root):
+        if name.startswith("calendarMonth=") and name.removeprefix("calendarMonth=") >= months_from and name not in written:
+            shutil.rmtree(f"{root}/{name}")
+    for name in written:
+        shutil.rmtree(f"{root}/{name}", ignore_errors=True)
+        os.replace(f"{tmp}/{name}", f"{root}/{name}")
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+# Lazily scan a directory written by `write_partitioned`. `calendar_months` is an inclusive ("YYYY-MM", "YYYY-MM")
+# range where either end may be None. Both filters hit the partition columns first, so files outside the range or
+# bucket are never opened, and the participant filter then prunes row groups by their id statistics.
+def scan_trajectories(
+    root: str,
+    calendar_months: tuple[str | None, str | None] | None = None,
+    participant_ids: list[str] | None = None,
+    columns: list[str] | None = None,
+) -> pl.LazyFrame:
+    with open(f"{root}/_layout.json") as f:
+        layout = json.load(f)
+    id_column = layout["idColumn"]
+    hive_schema = {key: _HIVE_SCHEMA[key] for key in layout["partitionBy"]}
+
+    traj = pl.scan_parquet(f"{root}/**/*.parquet", hive_partitioning=True, hive_schema=hive_schema)
+
+    if calendar_months is not None:
+        start, end = calendar_months
+        if start is not None:
+            traj = traj.filter(pl.col("calendarMonth") >= start)
+        if end is not None:
+            traj = traj.filter(pl.col("calendarMonth") <= end)
+
+    if participant_ids is not None:
+        ids = pl.Series(id_column, participant_ids, dtype=pl.String)
+        if "participantBucket" in layout["partitionBy"]:
+            wanted_buckets = participant_bucket(ids, layout["buckets"]).unique()
+            traj = traj.filter(pl.col("participantBucket").is_in(wanted_buckets.implode()))
+        traj = traj.filter(pl.col(id_column).is_in(ids.implode()))
+
+    if columns is not None:
+        traj = traj.select(id_column, "userMonth", "calendarMonth", *[c for c in columns if c not in (id_column, "userMonth", "calendarMonth")])
+    elif "participantBucket" in layout["partitionBy"]:
+        traj = traj.drop("participantBucket")
+    return traj
@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import shutil
+from hashlib import md5
+
+import numpy as np
+import polars as pl
+
+from trajectory_store import stable_hash
+
+# Deterministic user sampling. A user is in a sample iff the stable hash of (salt, participant ID) falls below
+# fraction * 2**64, so membership depends on nothing but the ID: adding users never moves anyone else in or out, the
+# same user is picked in every trajectory table, and each table can be filtered on its own while it is written.
+# Different salts give independent samples. Many samples (disjoint splits or bootstrap replicates) are drawn at once
+# with `sample_assignments` and written with one pass over each table by `write_samples`.
+
+_HASH_RANGE = 2**64
+
+
+# md5 over the concatenated IDs, fed in chunks instead of building the concatenation as one string.
+# Equal to md5("".join(ids)), so digests stay comparable with earlier runs.
+def id_digest(ids: pl.Series, chunk_size: int = 100_000) -> str:
+    digest = md5()
+    for start in range(0, len(ids), chunk_size):
+        digest.update("".join(ids.slice(start, chunk_size).to_list()).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def hash_threshold(fraction: float) -> int:
+    if not 0 <= fraction <= 1:
+        raise ValueError(f"Sample fraction must be between 0 and 1, got {fraction}")
+    return min(int(fraction * _HASH_RANGE), _HASH_RANGE - 1)
+
+
+# Filter expression selecting the rows of sampled users. Hashes are computed batch by batch, so it also works inside
+# a streaming sink.
+def in_sample(column: str, fraction: float, salt: str = "") -> pl.Expr:
+    threshold = hash_threshold(fraction)
+    return pl.col(column).map_batches(lambda ids: stable_hash(ids, salt) < threshold, return_dtype=pl.Boolean)
+
+
+# Splitmix64 finalizer over uint64 arrays (wrapping arithmetic): derives the k-th of many independent-looking
+# hashes from one stable hash per user, so K samples cost one blake2b per ID rather than K
+def _mix(hashes: np.ndarray, k: int) -> np.ndarray:
+    # The increment is wrapped in Python ints: numpy warns on scalar uint64 overflow (arrays wrap silently)
+    z = hashes + np.uint64((k + 1) * 0x9E3779B97F4A7C15 % 2**64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _poisson_cdf(rate: float) -> np.ndarray:
+    pmf, cdf = [math.exp(-rate)], [math.exp(-rate)]
+    while 1 - cdf[-1] > 1e-15:
+        pmf.append(pmf[-1] * rate / len(pmf))
+        cdf.append(cdf[-1] + pmf[-1])
+    return np.array(cdf)
+
+
+# Which users go into which of `samples` samples, as rows (participantId, sample[, weight]).
+#   - Disjoint: the hash range is cut into consecutive slices of width fraction * 2**64 and slice k is sample k, so
+#     samples never overlap, and sample 0 is exactly the users `in_sample(..., fraction, salt)` keeps.
+#   - Bootstrap: each sample draws every user a Poisson(fraction) number of times (the one-pass Poisson bootstrap),
+#     recorded as `weight`; users drawn zero times are left out.
+def sample_assignments(ids: pl.Series, samples: int, fraction: float, salt: str = "", bootstrap: bool = False) -> pl.DataFrame:
+    unique = ids.unique().sort()
+    hashes = stable_hash(unique, salt).to_numpy()
+
+    if not bootstrap:
+        if samples * fraction > 1:
+            raise ValueError(f"{samples} disjoint samples of fraction {fraction} do not fit in the population")
+        width = hash_threshold(fraction)
+        if width == 0:
+            raise ValueError(f"Sample fraction {fraction} is too small")
+        sample = hashes // np.uint64(width)
+        keep = sample < samples
+        return pl.DataFrame({"participantId": unique.filter(pl.Series(keep)), "sample": sample[keep]}).with_columns(
+            pl.col("sample").cast(pl.UInt16)
+        ).sort("sample", "participantId")
+
+    cdf = _poisson_cdf(fraction)
+    draws = []
+    for k in range(samples):
+        uniform = (_mix(hashes, k) >> np.uint64(11)).astype(np.float64) / 2.0**53
+        weight = np.searchsorted(cdf, uniform, side="right")
+        keep = weight > 0
+        draws.append(pl.DataFrame({
+            "participantId": unique.filter(pl.Series(keep)),
+            "sample": pl.Series(np.full(int(keep.sum()), k), dtype=pl.UInt16),
+            "weight": pl.Series(weight[keep], dtype=pl.UInt32),
+        }))
+    return pl.concat(draws)
+
+
+# Write each table's rows for every sample in one pass over the table, as
+#   {root}/sample_007/user_rating_traj.parquet
+# plus a _samples.json recording how the samples were drawn. `tables` maps trajectory file paths to their ID column.
+def write_samples(tables: dict[str, str], assignments: pl.DataFrame, root: str, description: dict) -> None:
+    tmp = f"{root}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    for path, id_column in tables.items():
+        name = os.path.basename(path).removesuffix(".parquet")
+        (
+            pl.scan_parquet(path)
+            .join(assignments.lazy().rename({"participantId": id_column}), on=id_column, how="inner")
+            .sort("sample", id_column, "userMonth")
+            .sink_parquet(
+                pl.PartitionBy(
+                    tmp, key="sample", include_key=False, approximate_bytes_per_file=None,
+                    file_path_provider=lambda args, name=name: (
+                        f"sample_{args.partition_keys['sample'][0]:03d}/{name}"
+                        + (f"-{args.index_in_partition}" if args.index_in_partition else "") + ".parquet"
+                    ),
+                ),
+                mkdir=True,
+            )
+        )
+    with open(f"{tmp}/_samples.json", "w") as f:
+        json.dump(description, f)
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
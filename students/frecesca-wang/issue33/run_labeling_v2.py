@@ -7,6 +7,13 @@ Issue #33: LLM Annotation v2
 
 Usage (from repo root):
   python students/frecesca-wang/issue33/run_labeling_v2.py
+  python students/frecesca-wang/issue33/run_labeling_v2.py --batch                  # via the Batch API
+  python students/frecesca-wang/issue33/run_labeling_v2.py --batch --backend file   # dry run, local fake backend
+
+With --batch, all prompts of both sets and both modes are rendered into JSONL request files
+and submitted as batches (processing/llm_batch.py); the script polls until they finish and
+writes the same outputs from the results. Re-running it while batches are still pending
+re-attaches to them rather than submitting again.
 
 Outputs:
   students/frecesca-wang/issue33/outputs/
@@ -23,9 +30,11 @@ Outputs:
 
 from __future__ import annotations
 
+import argparse
 import json
 import os
 import re
+import sys
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
@@ -49,6 +58,7 @@ REPO_ROOT = Path(__file__).resolve().parents[3]  # .../students/frecesca-wang/is
 DATA_DIR = REPO_ROOT / "data"
 ISSUE_DIR = REPO_ROOT / "students" / "frecesca-wang" / "issue33"
 OUT_DIR = ISSUE_DIR / "outputs"
+BATCH_DIR = OUT_DIR / "batch"
 
 SET1_DATA = DATA_DIR / "cn_sample_1.csv"
 SET2_DATA = DATA_DIR / "cn_sample_2.csv"
@@ -63,6 +73,8 @@ MODEL_NAME = "gpt-4.1-mini"
 # Units: dollars per 1M tokens
 PRICE_INPUT_PER_1M = 0.0
 PRICE_OUTPUT_PER_1M = 0.0
+# Batch API requests are billed at half the price
+BATCH_PRICE_FACTOR = 0.5
 
 # How many failure cases to save per run
 MAX_FAILURES_TO_SAVE = 40
@@ -203,6 +215,19 @@ def llm_label(client: OpenAI, model: str, prompt: str) -> Tuple[str, int, int]:
     return normalize_label(out_text), in_tok, out_tok
 
 
+def build_prompt(r: pd.Series, mode: str) -> Tuple[str, str]:
+    """
+    Returns: (text used, prompt). mode: "full" uses df.full_text; "note" uses df.summary
+    """
+    if mode == "full":
+        content = str(r["full_text"])
+        return content, PROMPT_TEMPLATE_FULL.format(post_text=content)
+    if mode == "note":
+        content = str(r["summary"])
+        return content, PROMPT_TEMPLATE_NOTE_ONLY.format(note_text=content)
+    raise ValueError("mode must be 'full' or 'note'")
+
+
 def run_one_mode(
     client: OpenAI,
     df: pd.DataFrame,
@@ -213,6 +238,24 @@ def run_one_mode(
     """
     mode: "full" uses df.full_text; "note" uses df.summary
     """
+    preds = [
+        llm_label(client, MODEL_NAME, build_prompt(r, mode)[1])
+        for _, r in tqdm(df.iterrows(), total=len(df), desc=f"Labeling ({mode})")
+    ]
+    return write_predictions(df, mode, preds, out_csv, failures_csv)
+
+
+def write_predictions(
+    df: pd.DataFrame,
+    mode: str,
+    preds: List[Tuple[str, int, int]],
+    out_csv: Path,
+    failures_csv: Path,
+    price_factor: float = 1.0,
+) -> RunMetrics:
+    """
+    preds: (label, input_tokens, output_tokens) for each row of df, in order
+    """
     rows: List[Dict] = []
     failures: List[Dict] = []
 
@@ -224,21 +267,11 @@ def run_one_mode(
     sum_out = 0
     sum_cost = 0.0
 
-    for _, r in tqdm(df.iterrows(), total=total, desc=f"Labeling ({mode})"):
+    for (_, r), (pred, in_tok, out_tok) in zip(df.iterrows(), preds):
         post_id = r["post_id"]
         gold = str(r["hand_label"]).strip().upper()
-
-        if mode == "full":
-            content = str(r["full_text"])
-            prompt = PROMPT_TEMPLATE_FULL.format(post_text=content)
-        elif mode == "note":
-            content = str(r["summary"])
-            prompt = PROMPT_TEMPLATE_NOTE_ONLY.format(note_text=content)
-        else:
-            raise ValueError("mode must be 'full' or 'note'")
-
-        pred, in_tok, out_tok = llm_label(client, MODEL_NAME, prompt)
-        cost = estimate_cost_usd(in_tok, out_tok)
+        content, _ = build_prompt(r, mode)
+        cost = estimate_cost_usd(in_tok, out_tok) * price_factor
 
         sum_in += in_tok
         sum_out += out_tok
@@ -300,35 +333,78 @@ def run_one_mode(
     )
 
 
+def label_all_batch(
+    sets: Dict[str, pd.DataFrame],
+    backend: str,
+    poll_seconds: float,
+) -> Dict[Tuple[str, str], List[Tuple[str, int, int]]]:
+    """
+    Labels every row of every set in both modes through one batch run.
+    Returns: (label, input_tokens, output_tokens) per row, keyed by (set_name, mode)
+    """
+    # Imported here so the per-request mode does not need the processing/ dependencies
+    sys.path.insert(0, str(REPO_ROOT / "processing"))
+    from llm_batch import FileBatchBackend, OpenAIBatchBackend, label_batch
+
+    if backend == "file":
+        batch_backend = FileBatchBackend(str(BATCH_DIR / "file_backend"))
+    else:
+        load_api_key()
+        batch_backend = OpenAIBatchBackend()
+
+    jobs = [(set_name, mode, df) for set_name, df in sets.items() for mode in ("full", "note")]
+    custom_ids = [f"{set_name}/{mode}/{i}" for set_name, mode, df in jobs for i in range(len(df))]
+    prompts = [build_prompt(r, mode)[1] for _, mode, df in jobs for _, r in df.iterrows()]
+
+    # Requests the batches did not answer stay INVALID
+    preds = {(set_name, mode): [("INVALID", 0, 0)] * len(df) for set_name, mode, df in jobs}
+    failed = 0
+    for custom_id, result in label_batch(
+        batch_backend, custom_ids, prompts, str(BATCH_DIR / backend), MODEL_NAME, poll_seconds
+    ):
+        set_name, mode, i = custom_id.split("/")
+        if result.error is not None:
+            failed += 1
+        preds[(set_name, mode)][int(i)] = (normalize_label(result.output_text), result.input_tokens, result.output_tokens)
+    if failed:
+        print(f"[WARN] {failed} of {len(custom_ids)} batch requests failed; their predictions are INVALID.")
+    return preds
+
+
 def main() -> None:
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    parser = argparse.ArgumentParser(description="Predict hand labels from full post text and from note text only.")
+    parser.add_argument("--batch", action="store_true", help="Label through batches instead of one request per row")
+    parser.add_argument("--backend", choices=["openai", "file"], default="openai",
+                        help="Batch backend: the OpenAI Batch API, or a local fake that answers NONE")
+    parser.add_argument("--poll-seconds", type=float, default=60.0, help="Seconds between batch status checks")
+    args = parser.parse_args()
 
-    load_api_key()
-    client = OpenAI()
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
 
     # Load + merge
     set1 = merge_labels(read_dataset(SET1_DATA), read_handlabels(SET1_HAND))
     set2 = merge_labels(read_dataset(SET2_DATA), read_handlabels(SET2_HAND))
 
+    if args.batch:
+        batch_preds = label_all_batch({"set1": set1, "set2": set2}, args.backend, args.poll_seconds)
+    else:
+        load_api_key()
+        client = OpenAI()
+
     metrics_all: Dict[str, Dict] = {}
 
+    def label_mode(set_name: str, df: pd.DataFrame, mode: str) -> RunMetrics:
+        out_csv = OUT_DIR / f"{set_name}_{mode}_predictions.csv"
+        failures_csv = OUT_DIR / f"failure_cases_{set_name}_{mode}.csv"
+        if args.batch:
+            return write_predictions(df, mode, batch_preds[(set_name, mode)], out_csv, failures_csv, BATCH_PRICE_FACTOR)
+        return run_one_mode(client=client, df=df, mode=mode, out_csv=out_csv, failures_csv=failures_csv)
+
     def do_set(set_name: str, df: pd.DataFrame):
         # Step 2: FULL
-        m_full = run_one_mode(
-            client=client,
-            df=df,
-            mode="full",
-            out_csv=OUT_DIR / f"{set_name}_full_predictions.csv",
-            failures_csv=OUT_DIR / f"failure_cases_{set_name}_full.csv",
-        )
+        m_full = label_mode(set_name, df, "full")
         # Step 3: NOTE ONLY
-        m_note = run_one_mode(
-            client=client,
-            df=df,
-            mode="note",
-            out_csv=OUT_DIR / f"{set_name}_note_predictions.csv",
-            failures_csv=OUT_DIR / f"failure_cases_{set_name}_note.csv",
-        )
+        m_note = label_mode(set_name, df, "note")
 
         metrics_all[set_name] = {
             "full": m_full.__dict__,
@@ -352,6 +428,8 @@ def main() -> None:
         "model": MODEL_NAME,
         "price_input_per_1m": PRICE_INPUT_PER_1M,
         "price_output_per_1m": PRICE_OUTPUT_PER_1M,
+        "batch": args.batch,
+        "price_factor": BATCH_PRICE_FACTOR if args.batch else 1.0,
         "note": "If prices are 0, report token counts and explain pricing not filled.",
         "metrics": metrics_all,
     }, indent=2), encoding="utf-8")
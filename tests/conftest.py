@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The processing modules import each other as siblings (`from llm_labeling import ...`), as when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "processing"))
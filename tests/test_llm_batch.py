@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import polars as pl
+from openai import AsyncOpenAI
+
+from llm_batch import FileBatchBackend, label_frame_batch
+from llm_labeling import LabelingEngine, MockResponsesServer
+
+
+def _respond(prompt: str) -> str:
+    if prompt == "post 3":
+        raise RuntimeError("model overloaded")
+    return f"label for {prompt}"
+
+
+# label_frame_batch runs its own event loop, so the mock server gets one in a thread
+@contextmanager
+def _mock_server(**options):
+    started, stop = threading.Event(), None
+    holder = {}
+
+    async def serve():
+        nonlocal stop
+        stop = asyncio.Event()
+        async with MockResponsesServer(**options) as server:
+            holder["server"] = server
+            started.set()
+            await stop.wait()
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),))
+    thread.start()
+    started.wait()
+    try:
+        yield holder["server"]
+    finally:
+        loop.call_soon_threadsafe(stop.set)
+        thread.join()
+        loop.close()
+
+
+def test_batch_cycle_with_failed_row(tmp_path):
+    backend = FileBatchBackend(str(tmp_path / "backend"), respond=_respond, polls=2)
+    frame = pl.DataFrame({"post_id": [10, 11, 12, 13, 14]})
+    prompts = [f"post {i}" for i in range(5)]
+
+    labeled = label_frame_batch(backend, frame, prompts, str(tmp_path / "work"), poll_seconds=0)
+
+    assert backend.submitted == 1
+    assert labeled["post_id"].to_list() == [10, 11, 12, 13, 14]
+    assert labeled["llm_output"].to_list() == ["label for post 0", "label for post 1", "label for post 2", None, "label for post 4"]
+    assert labeled["llm_error"].null_count() == 4
+    assert "model overloaded" in labeled["llm_error"][3]
+
+
+def test_failed_row_falls_back_to_live_requests(tmp_path):
+    backend = FileBatchBackend(str(tmp_path / "backend"), respond=_respond, polls=2)
+    frame = pl.DataFrame({"post_id": [10, 11, 12, 13, 14]})
+    prompts = [f"post {i}" for i in range(5)]
+
+    with _mock_server(respond=lambda prompt: f"live label for {prompt}", latency=0) as server:
+        engine = LabelingEngine(AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0))
+        labeled = label_frame_batch(backend, frame, prompts, str(tmp_path / "work"), poll_seconds=0, fallback=engine)
+
+    # Only the failed row went out live
+    assert server.requests == 1
+    assert labeled["llm_output"].to_list() == [
+        "label for post 0", "label for post 1", "label for post 2", "live label for post 3", "label for post 4",
+    ]
+    assert labeled["llm_error"].null_count() == 5
@@ -0,0 +1,43 @@
+import asyncio
+
+from openai import AsyncOpenAI
+
+from llm_labeling import LabelingEngine, MockResponsesServer
+
+
+def _label_against_mock(prompts: list[str], max_concurrency: int, **server_options) -> tuple[list, MockResponsesServer, LabelingEngine]:
+    async def run():
+        async with MockResponsesServer(respond=lambda prompt: f"label for {prompt}", **server_options) as server:
+            client = AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+            # Far above the mock's limit, so the engine has to back off on 429s to get through
+            engine = LabelingEngine(client, max_concurrency=max_concurrency, requests_per_minute=60_000, tokens_per_minute=10_000_000)
+            return await engine.label(prompts), server, engine
+
+    return asyncio.run(run())
+
+
+def test_labels_everything_despite_rate_limits():
+    prompts = [f"post {i}" for i in range(60)]
+    # 20 requests per second
+    results, server, engine = _label_against_mock(prompts, max_concurrency=8, requests_per_minute=1200, window_seconds=1.0, latency=0.01)
+
+    assert server.rejected > 0
+    assert engine.stats.rate_limited == server.rejected
+    assert all(result.error is None for result in results)
+    assert server.requests == len(prompts)
+
+
+def test_results_keep_input_order():
+    prompts = [f"post {i}" for i in range(50)]
+    # Ten requests are in flight at a time and finish in whatever order the server answers them
+    results, _, _ = _label_against_mock(prompts, max_concurrency=10, latency=0.02)
+
+    assert [result.output_text for result in results] == [f"label for {prompt}" for prompt in prompts]
+
+
+def test_concurrency_cap_holds():
+    prompts = [f"post {i}" for i in range(80)]
+    results, server, _ = _label_against_mock(prompts, max_concurrency=4, latency=0.05)
+
+    assert all(result.error is None for result in results)
+    assert server.peak_in_flight == 4